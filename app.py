@@ -1,7 +1,14 @@
-from flask import Flask, request, jsonify, render_template, redirect, send_from_directory, url_for
+from flask import Flask, request, jsonify, render_template, redirect, send_from_directory, url_for, Response
 import os
+import gc
 import json
 from rag import get_model_version  
+from sessions import SessionRegistry
+from ingestion import IngestionQueue, RemoteIngestionQueue
+from cluster import CollectionEvents, RedisChannelStore, RedisJobStore, redis_client
+from history_store import get_history_store
+from streaming import StreamManager, ChunkBatcher, StreamCancelled
+from metrics import registry, tracer, REQUESTS
 from flask_socketio import SocketIO, join_room, leave_room, send, emit
 import datetime as dt
 from uuid import uuid4
@@ -10,22 +17,83 @@ from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key'
-app.config['UPLOAD_FOLDER'] = 'uploads'
-socketio = SocketIO(app)
+app.config['UPLOAD_FOLDER'] = os.getenv('LUNA_UPLOAD_FOLDER', 'uploads')
+app.config['HISTORY_BACKEND'] = 'sqlite' # 'sqlite', 'jsonl' or 'redis'
+app.config['HISTORY_PATH'] = 'chat_history.sqlite'
+# Multi-worker mode: with LUNA_REDIS_URL set, any number of workers (processes or nodes) can serve the app,
+# e.g. `gunicorn -w 4 --threads 64 app:app`. The Socket.IO events are relayed between them through Redis,
+# the channels, chat history and ingestion jobs are stored in it and the vector db is written by a single
+# ingestion_worker.py. The clients connect with websockets only, so no sticky sessions are needed.
+# LUNA_UPLOAD_FOLDER must then be on storage shared by the workers and the writer.
+REDIS_URL = os.getenv('LUNA_REDIS_URL')
+if REDIS_URL:
+    app.config['HISTORY_BACKEND'] = 'redis'
+    app.config['HISTORY_PATH'] = REDIS_URL
+socketio = SocketIO(app, message_queue=REDIS_URL)
 CHAT_HISTORY_FILE = 'chat_history.json'
 
-ragmodel = get_model_version("config.yml", "CohereModels", "luna-1")
+# LUNA_MODEL_VERSION=luna-offline serves the app with the offline LLM backend, e.g. for load tests
+ragmodel = get_model_version("config.yml", "CohereModels", os.getenv("LUNA_MODEL_VERSION", "luna-1"))
 print(ragmodel)
-# Load existing chat history from JSON file or initialize an empty dictionary
-if os.path.exists(CHAT_HISTORY_FILE):
-    with open(CHAT_HISTORY_FILE, 'r') as file:
-        chat_history = json.load(file)
+if REDIS_URL:
+    redis = redis_client(REDIS_URL)
+    channel_store = RedisChannelStore(redis, ragmodel.model_name)
+    channel_store.seed(ragmodel.CHANNELS)
+    ragmodel.channel_store = channel_store
+    # the collections are written by ingestion_worker.py only, and opened again once it changed them
+    # (see start_worker)
+    ragmodel.read_only = True
+    collection_events = CollectionEvents(redis)
+# the embedder is otherwise loaded on first use. LUNA_PRELOAD=1 loads it at import, e.g. in the master of
+# `gunicorn --preload` so that the forked workers share it copy-on-write
+if os.getenv("LUNA_PRELOAD") == "1":
+    ragmodel.warm_up()
+    gc.freeze()
+sessions = SessionRegistry(ragmodel)
+# LLM answers are generated in a worker pool, at most `backend_limits` at a time per LLM backend
+streams = StreamManager(max_workers=ragmodel.streaming_config.get('max_workers', 32),
+                        backend_limits=ragmodel.streaming_config.get('backend_limits'),
+                        queue_size=ragmodel.streaming_config.get('queue_size', 64),
+                        stall_timeout=ragmodel.streaming_config.get('stall_timeout', 60))
+
+def report_ingestion_progress(job):
+    socketio.emit('ingestion_progress', job.to_dict(), room=job.sid or job.topic)
+
+def collect_cache_metrics():
+    stats = ragmodel.cache_stats()
+    return [
+        ('luna_cache_hits_total', 'counter', 'Cache hits.', [({'cache': name}, s['hits']) for name, s in stats.items()]),
+        ('luna_cache_misses_total', 'counter', 'Cache misses.', [({'cache': name}, s['misses']) for name, s in stats.items()]),
+        ('luna_cache_entries', 'gauge', 'Entries held by the cache.', [({'cache': name}, s.get('size', s.get('entries'))) for name, s in stats.items() if 'size' in s or 'entries' in s]),
+    ]
+
+registry.register_collector(collect_cache_metrics)
+
+if REDIS_URL:
+    # the jobs are run (and their progress reported) by ingestion_worker.py
+    ingestion_queue = RemoteIngestionQueue(ragmodel, RedisJobStore(redis))
 else:
-    chat_history = {}
+    ingestion_queue = IngestionQueue(ragmodel, max_workers=ragmodel.ingestion_config.get('max_workers'),
+                                     batch_size=ragmodel.ingestion_config.get('batch_size', 256),
+                                     stream_above_mb=ragmodel.ingestion_config.get('stream_above_mb'),
+                                     stream_batch_size=ragmodel.ingestion_config.get('stream_batch_size', 64),
+                                     on_progress=report_ingestion_progress)
+chat_history = get_history_store(app.config['HISTORY_BACKEND'], app.config['HISTORY_PATH'])
+# Import the chat history of the old JSON file on the first start with the new store
+if chat_history.is_empty() and os.path.exists(CHAT_HISTORY_FILE):
+    with open(CHAT_HISTORY_FILE, 'r') as file:
+        chat_history.import_legacy(json.load(file))
+
+@app.before_request
+def start_worker():
+    # the threads of a worker are started by its first request or connection, not at import: the workers forked
+    # by gunicorn --preload don't inherit the threads of the master (the ingestion queue starts on its first job)
+    if REDIS_URL:
+        collection_events.subscribe(ragmodel.reload_topic)
 
-def save_chat_history():
-    with open(CHAT_HISTORY_FILE, 'w') as file:
-        json.dump(chat_history, file)
+@socketio.on('connect')
+def on_connect():
+    start_worker()
 
 @app.route('/')
 def index():
@@ -43,13 +111,8 @@ def on_join(data):
     username = data['username']
     room = data['room']
     join_room(room)
-    ragmodel.set_topic(room)
-    ragmodel.set_user(username)
-    ragmodel.chat_history = []
-    if username not in chat_history:
-        chat_history[username] = {}
-    if room not in chat_history[username]:
-        chat_history[username][room] = {}
+    sessions.open(request.sid, room, username)
+    chat_history.add_room(username, room)
 
     message = {
         'msg': f'{username} has entered the room.',
@@ -68,63 +131,87 @@ def handle_message(data):
     sender = data['sender']
     internet_search = data['internetSearch']
     message_id = data.get('messageId')
-    print(room, msg, sender, internet_search, message_id)
     conversation_id = data.get('conversation_id')
     timestamp = dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     if not conversation_id:
         conversation_id = str(uuid4())
-        if sender in chat_history:
-            if room in chat_history[sender]:
-                chat_history[sender][room][conversation_id] = []
-            else:
-                chat_history[sender][room] = {conversation_id: []}
-        else:
-            chat_history[sender] = {room: {conversation_id: []}}
         socketio.emit('new_conversation_id', conversation_id, room=request.sid)
-    else:
-        if sender not in chat_history:
-            chat_history[sender] = {}
-        if room not in chat_history[sender]:
-            chat_history[sender][room] = {}
-        if conversation_id not in chat_history[sender][room]:
-            chat_history[sender][room][conversation_id] = []
+    chat_history.add_conversation(sender, room, conversation_id)
 
     message = {'msg': msg, 'sender': sender, 'timestamp': timestamp, 'message_id': message_id}
-    chat_history[sender][room][conversation_id].append(message)
-    save_chat_history()
+    chat_history.append(sender, room, conversation_id, message)
     send(message, to=room)
 
     # Generate a response from the RagModel and stream it
     response_message = {'msg': '', 'sender': 'Mitsis A.I. Assistant', 'timestamp': dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
     emit('message', response_message, room=room)  # Send a placeholder message to create the element
 
-    response_chunks = ragmodel.generate_stream_response(query=msg, search_web=internet_search)
-
-    with open('response.txt', 'a', encoding='utf-8') as file:
+    session = sessions.get(request.sid, room, sender)
+    # one series per channel: the room comes from the client, anything else is counted together
+    REQUESTS.inc(room=room if room in ragmodel.CHANNELS else "other")
+    # the answer is generated and emitted in the background, the handler returns right away
+    socketio.start_background_task(stream_answer, session, (request.sid, room), msg, internet_search, room, 
+                                   message_id, sender, conversation_id, response_message)
+
+@socketio.on('prefetch')
+def handle_prefetch(data):
+    # the client sends the message being typed, its retrieval starts before it is sent
+    sessions.get(request.sid, data['room'], data.get('sender')).prefetch(data['msg'])
+
+def stream_answer(session, key, msg, internet_search, room, message_id, sender, conversation_id, response_message):
+    # every stage of the pipeline (vector search, rerank, llm...) is recorded as a span of this trace
+    with tracer.trace('message', conversation_id=conversation_id, room=room, user=sender, search_web=internet_search):
+        stream = streams.start(key, ragmodel.chat_backend, 
+                               lambda: session.generate_stream_response(query=msg, search_web=internet_search))
+
+        # tokens are sent in batches of `flush_bytes` bytes or `flush_interval` seconds, to the client that asked
+        # (the only one listening to them), which acknowledges them: when it falls `max_unacked_chunks` behind,
+        # the answer is no longer read from the LLM until it catches up
+        batcher = ChunkBatcher(lambda text, ack: socketio.emit(f'message_chunk_{message_id}', {'chunk': text}, to=key[0], callback=ack),
+                               flush_bytes=ragmodel.streaming_config.get('flush_bytes', 256),
+                               flush_interval=ragmodel.streaming_config.get('flush_interval', 0.03),
+                               max_unacked=ragmodel.streaming_config.get('max_unacked_chunks', 8),
+                               ack_timeout=streams.stall_timeout or None)
         sources = None
         first_chunk = True
-        for chunk in response_chunks:
-            if first_chunk:
-                emit(f'message_chunk_{message_id}', {'chunk': 'response_start'}, room=room)
-                first_chunk = False
-            if chunk == "response_end":
-                emit(f'message_chunk_{message_id}', {'chunk': chunk}, room=room)
-            elif isinstance(chunk, dict):
-                sources = chunk
-            else:
-                emit(f'message_chunk_{message_id}', {'chunk': chunk}, room=room)
-                response_message['msg'] += chunk
-                file.write(chunk)
-        file.write('\n')
-
+        try:
+            for chunk in stream.iter(timeout=batcher.flush_interval):
+                if chunk is None:
+                    batcher.tick()
+                    continue
+                if first_chunk:
+                    socketio.emit(f'message_chunk_{message_id}', {'chunk': 'response_start'}, room=room)
+                    first_chunk = False
+                if chunk == "response_end":
+                    batcher.flush()
+                    socketio.emit(f'message_chunk_{message_id}', {'chunk': chunk}, room=room)
+                elif isinstance(chunk, dict):
+                    sources = chunk
+                else:
+                    batcher.add(chunk)
+            batcher.flush()
+        except StreamCancelled:
+            # the client stopped acknowledging the chunks
+            stream.cancel()
+        response_message['msg'] = batcher.text
+
+        # one write per answer
+        with open('response.txt', 'a', encoding='utf-8') as file:
+            file.write(response_message['msg'] + '\n')
+
+    if stream.cancelled.is_set():
+        print(f"Answer to {sender} in {room} cancelled")
+    elif stream.error and first_chunk:
+        socketio.emit(f'message_chunk_{message_id}', {'chunk': 'response_start'}, room=room)
+        socketio.emit(f'message_chunk_{message_id}', {'chunk': 'Sorry, something went wrong while generating the answer.'}, room=room)
+        socketio.emit(f'message_chunk_{message_id}', {'chunk': 'response_end'}, room=room)
     if sources:
-        emit(f'message_chunk_{message_id}_sources', {'sources': sources}, room=room)
-        print(sources)
+        socketio.emit(f'message_chunk_{message_id}_sources', {'sources': sources}, room=room)
     else:
-        emit(f'message_chunk_{message_id}_sources', {'sources': {}}, room=room)
-    chat_history[sender][room][conversation_id].append(response_message)
-    save_chat_history()
+        socketio.emit(f'message_chunk_{message_id}_sources', {'sources': {}}, room=room)
+    if response_message['msg']:
+        chat_history.append(sender, room, conversation_id, response_message)
 
 
 @socketio.on('leave')
@@ -132,15 +219,20 @@ def on_leave(data):
     username = data['username']
     room = data['room']
     leave_room(room)
+    streams.cancel(request.sid, room)
+    sessions.close(request.sid, room)
     message = {
         'msg': f'{username} has left the room.',
         'sender': 'System',
         'timestamp': dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }
-    if username in chat_history and room in chat_history[username]:
-        chat_history[username][room].append(message)
     send(message, to=room)
 
+@socketio.on('disconnect')
+def on_disconnect():
+    streams.cancel(request.sid)
+    sessions.close(request.sid)
+
 @socketio.on('get_channels')
 def get_channels(data):
     CHANNELS = ragmodel.CHANNELS
@@ -164,10 +256,13 @@ def upload():
         return "No files part", 400
 
     files = request.files.getlist('files')
+    room = request.form.get('room', 'general')
+    sid = request.form.get('sid')
     print(files)
     if not files:
         return "No selected files", 400
 
+    filepaths = []
     for file in files:
         if file.filename == '':
             return "One or more files have no selected file", 400
@@ -177,13 +272,18 @@ def upload():
             filename = secure_filename(file.filename)
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             file.save(filepath)
+            filepaths.append(filepath)
 
-            doc = ragmodel.load_document(path=filepath)
-            splitted_doc = ragmodel.split_text(doc)
-            ragmodel.add_document_to_vectorstore(splitted_doc)
-          
+    # the files are parsed and embedded in the background, progress is reported with 'ingestion_progress' events
+    job = ingestion_queue.submit(filepaths, topic=room, sid=sid)
+    return jsonify(job.to_dict()), 202
 
-    return "Files uploaded and processed successfully.", 200
+@app.route('/upload/<job_id>')
+def upload_status(job_id):
+    job = ingestion_queue.status(job_id)
+    if not job:
+        return jsonify({'message': 'Unknown job'}), 404
+    return jsonify(job)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
@@ -203,29 +303,39 @@ def save_response():
     with open(os.path.join(app.config['UPLOAD_FOLDER'], f'{user}_{room}.txt'), 'w') as file:
         file.write(content)
 
-    doc = ragmodel.load_document(path=os.path.join(app.config['UPLOAD_FOLDER'], f'{user}_{room}.txt'))
-    splitted_doc = ragmodel.split_text(doc)
-    ragmodel.add_document_to_vectorstore(splitted_doc)
+    # only the chunks that changed since the last saved response are re-indexed
+    if REDIS_URL:
+        ingestion_queue.submit([os.path.join(app.config['UPLOAD_FOLDER'], f'{user}_{room}.txt')], topic=room)
+    else:
+        ragmodel.index_file(os.path.join(app.config['UPLOAD_FOLDER'], f'{user}_{room}.txt'), topic=room)
 
     return jsonify({'message': 'Response saved successfully'}), 200
 
 
+@app.route('/stats')
+def get_stats():
+    return jsonify(ragmodel.cache_stats())
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/traces')
+def traces():
+    return jsonify(tracer.recent(int(request.args.get('limit', 50))))
+
+
 @app.route('/history/<username>/<room>/<conversation_id>')
 def get_history(username, room, conversation_id):
-    if username in chat_history and room in chat_history[username]:
-        if conversation_id in chat_history[username][room]:
-            return jsonify(chat_history[username][room][conversation_id])
-    return jsonify([])
+    return jsonify(chat_history.get_messages(username, room, conversation_id))
 
 @app.route('/conversations/<username>')
 def get_conversations(username):
-    if username in chat_history:
-        return jsonify({
-            room: list(chat_history[username][room].keys())
-            for room in chat_history[username] if isinstance(chat_history[username][room], dict)
-        })
-    return jsonify({})
+    return jsonify(chat_history.get_conversations(username))
 
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, port=5050)
\ No newline at end of file
+    # run from run.py, so that the spawned parse workers of the ingestion queue don't import this module (see run.py)
+    import sys
+    run = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py")
+    os.execv(sys.executable, [sys.executable, run] + sys.argv[1:])
\ No newline at end of file
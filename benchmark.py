@@ -0,0 +1,259 @@
+"""
+Offline benchmark of the RAG pipeline.
+
+Builds a throwaway collection from a synthetic corpus (or the files of --corpus) with the real
+load_document / split_text / embedder / Chroma path of each model version, replaces the LLM with the
+offline FakeBackend (and a Cohere reranker with NoReranker) and reports ingestion throughput, retrieval,
+rerank and streaming latencies as JSON. Without a real reranker (NoReranker) there is no rerank stage to report.
+
+Example:
+    python benchmark.py --versions luna-1 luna-2 --chunk-sizes 1000 3000 --k 10 20 --output benchmark_results.json
+
+With --micro, only the post-processing of the retrieved chunks (prompt snippets and grouped sources) is
+timed against the previous implementation, for each --micro-k:
+    python benchmark.py --micro --micro-k 20 100 500
+"""
+import argparse
+import contextlib
+import copy
+import datetime as dt
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from langchain_core.documents import Document
+
+from rag import MyRAGModel, clean_text, group_sources, load_model_from_yaml, prompt_document
+from rerankers import CohereReranker, NoReranker
+from llm_backends import FakeBackend
+
+
+WORDS = ("route vehicle depot customer capacity heuristic neighborhood search tabu swap python function class "
+         "module list dictionary generator decorator exception thread process vector embedding retrieval index "
+         "query document chunk language model optimization solution cost demand fleet schedule period").split()
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pct(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    return {"p50": pct(50), "p95": pct(95), "p99": pct(99), "mean": sum(values) / len(values),
+            "min": values[0], "max": values[-1], "n": len(values)}
+
+
+def make_corpus(directory, n_docs, paragraphs, seed):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(n_docs):
+        path = os.path.join(directory, f"doc_{i}.txt")
+        with open(path, "w", encoding="utf-8") as file:
+            for _ in range(paragraphs):
+                sentences = [" ".join(rng.choices(WORDS, k=rng.randint(8, 20))).capitalize() + "." for _ in range(rng.randint(3, 8))]
+                file.write(" ".join(sentences) + "\n\n")
+        paths.append(path)
+    return paths
+
+
+def make_queries(paths, n_queries, seed):
+    rng = random.Random(seed)
+    sentences = []
+    for path in paths:
+        with open(path, encoding="utf-8") as file:
+            sentences.extend(s.strip() for s in file.read().split(".") if len(s.split()) > 5)
+    return [" ".join(rng.choice(sentences).split()[:8]) + "?" for _ in range(n_queries)] if sentences else []
+
+
+def legacy_postprocess(docs):
+    # retrieve_documents before the snippets were precomputed: cleaned on every query, sources grouped in O(k²)
+    prompt_docs = [{"title": doc.metadata.get('source'), "snippet": clean_text(doc.page_content)} for doc in docs]
+    sources = [{"source": doc.metadata.get('source'), "page": doc.metadata.get('page'), "file_path": doc.metadata.get('file_path')} for doc in docs]
+    updated_sources = {}
+    for source in sources:
+        source_name = source["source"]
+        if source_name not in updated_sources:
+            pages = [s["page"] for s in sources if s["source"] == source_name and s["page"] is not None]
+            updated_sources[source_name] = {"pages": sorted(pages), "file_path": source["file_path"]}
+    return prompt_docs, updated_sources
+
+
+def postprocess(docs):
+    return [prompt_document(doc) for doc in docs], group_sources(docs)
+
+
+def micro_benchmark(ks, repeat, seed, chunk_words=200):
+    """
+    Times the post-processing of k retrieved chunks (spread over k / 4 files) with and without the snippets
+    precomputed at ingestion, in microseconds per query.
+    """
+    rng = random.Random(seed)
+    results = []
+    for k in ks:
+        docs = []
+        for i in range(k):
+            text = "\n".join(" ".join(rng.choices(WORDS, k=20)) for _ in range(chunk_words // 20))
+            source = f"doc_{rng.randrange(max(1, k // 4))}.pdf"
+            docs.append(Document(page_content=text, metadata={"source": source, "page": rng.randrange(100),
+                                                             "file_path": f"uploads/{source}", "snippet": clean_text(text)}))
+        timings = {}
+        for name, function in (("legacy", legacy_postprocess), ("current", postprocess)):
+            values = []
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                function(docs)
+                values.append((time.perf_counter() - t0) * 1e6)
+            timings[name] = percentiles(values)
+        results.append({"k": k, "legacy_us": timings["legacy"], "current_us": timings["current"],
+                        "speedup_p50": timings["legacy"]["p50"] / timings["current"]["p50"]})
+        print(f"k={k}: legacy p50 {timings['legacy']['p50']:.0f}us, current p50 {timings['current']['p50']:.0f}us "
+              f"({results[-1]['speedup_p50']:.1f}x)")
+    return results
+
+
+def run(config, paths, queries, llm):
+    model = MyRAGModel(topic=None, config=config)
+    model.llm = llm
+    if isinstance(model.reranker, CohereReranker):
+        model.reranker = NoReranker()
+    result = {}
+
+    # ingestion
+    chunks = 0
+    stage = {"load": 0.0, "split": 0.0, "embed_and_write": 0.0}
+    start = time.perf_counter()
+    for path in paths:
+        t0 = time.perf_counter()
+        document = model.load_document(path)
+        t1 = time.perf_counter()
+        splitted = model.split_text(document)
+        t2 = time.perf_counter()
+        model.add_document_to_vectorstore(splitted, topic="benchmark")
+        t3 = time.perf_counter()
+        stage["load"] += t1 - t0
+        stage["split"] += t2 - t1
+        stage["embed_and_write"] += t3 - t2
+        chunks += len(splitted)
+    elapsed = time.perf_counter() - start
+    result["ingestion"] = {"documents": len(paths), "chunks": chunks, "seconds": elapsed,
+                           "docs_per_s": len(paths) / elapsed if elapsed else 0.0,
+                           "chunks_per_s": chunks / elapsed if elapsed else 0.0,
+                           "stage_seconds": stage}
+
+    # retrieval and rerank
+    session = model.new_session(topic="benchmark", user="benchmark")
+    reranks = not isinstance(model.reranker, NoReranker)
+    retrieval, rerank = [], []
+    for query in queries:
+        t0 = time.perf_counter()
+        docs, _ = session.retrieve_documents(query)
+        t1 = time.perf_counter()
+        retrieval.append((t1 - t0) * 1000)
+        if reranks:
+            model.reranker.rerank(query, docs, top_n=5)
+            rerank.append((time.perf_counter() - t1) * 1000)
+    result["retrieval_ms"] = percentiles(retrieval)
+    if reranks:
+        result["rerank_ms"] = percentiles(rerank)
+
+    # streaming, every query in a fresh session so that the chat history doesn't grow
+    first_chunk, total = [], []
+    for query in queries:
+        session = model.new_session(topic="benchmark", user="benchmark")
+        t0 = time.perf_counter()
+        first = None
+        for _ in session.generate_stream_response(query):
+            if first is None:
+                first = time.perf_counter()
+        end = time.perf_counter()
+        first_chunk.append(((first or end) - t0) * 1000)
+        total.append((end - t0) * 1000)
+    result["first_chunk_ms"] = percentiles(first_chunk)
+    result["stream_total_ms"] = percentiles(total)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the RAG pipeline")
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--family", default="CohereModels")
+    parser.add_argument("--versions", nargs="+", default=["luna-1"])
+    parser.add_argument("--chunk-sizes", nargs="*", type=int, default=[], help="override the chunk_size of the text splitter")
+    parser.add_argument("--chunk-overlap", type=int, default=None, help="override the chunk_overlap of the text splitter")
+    parser.add_argument("--k", nargs="*", type=int, default=[], help="override retrieval_k")
+    parser.add_argument("--corpus", default=None, help="directory of fixture documents, a synthetic corpus is generated otherwise")
+    parser.add_argument("--docs", type=int, default=20, help="number of synthetic documents")
+    parser.add_argument("--paragraphs", type=int, default=30, help="paragraphs per synthetic document")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--first-token-delay", type=float, default=0.0, help="seconds before the stub LLM streams its first token")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between two tokens of the stub LLM")
+    parser.add_argument("--tokens", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--micro", action="store_true", help="only time the post-processing of the retrieved chunks")
+    parser.add_argument("--micro-k", nargs="+", type=int, default=[20, 100, 500])
+    parser.add_argument("--micro-repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.micro:
+        report = {"timestamp": dt.datetime.now().isoformat(), "micro": micro_benchmark(args.micro_k, args.micro_repeat, args.seed)}
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+        return
+
+    workdir = tempfile.mkdtemp(prefix="luna_benchmark_")
+    try:
+        if args.corpus:
+            paths = sorted(os.path.join(args.corpus, name) for name in os.listdir(args.corpus))
+        else:
+            corpus_dir = os.path.join(workdir, "corpus")
+            os.makedirs(corpus_dir)
+            paths = make_corpus(corpus_dir, args.docs, args.paragraphs, args.seed)
+        queries = make_queries([p for p in paths if p.endswith(".txt")] or paths, args.queries, args.seed)
+        llm = FakeBackend(tokens=args.tokens, tokens_per_second=1.0 / args.token_delay if args.token_delay else None,
+                          first_token_delay=args.first_token_delay)
+
+        runs = []
+        for version in args.versions:
+            for chunk_size in args.chunk_sizes or [None]:
+                for k in args.k or [None]:
+                    config = copy.deepcopy(load_model_from_yaml(args.config, args.family, version))
+                    if chunk_size:
+                        config['text_splitter']['params']['chunk_size'] = chunk_size
+                    if args.chunk_overlap is not None:
+                        config['text_splitter']['params']['chunk_overlap'] = args.chunk_overlap
+                    if k:
+                        config['retrieval_k'] = k
+                    # every run starts from an empty, private vector db and caches
+                    run_dir = tempfile.mkdtemp(dir=workdir)
+                    config['vector_db_path'] = os.path.join(run_dir, "chroma_db")
+                    config.pop('embedding_cache', None)
+                    config.pop('response_cache', None)
+                    print(f"Benchmarking {version} (chunk_size={config['text_splitter']['params'].get('chunk_size')}, k={config.get('retrieval_k', 20)})...")
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        result = run(config, paths, queries, llm)
+                    runs.append({"model_version": version, "text_splitter": config['text_splitter'],
+                                 "retrieval_k": config.get('retrieval_k', 20), **result})
+                    print(json.dumps(runs[-1], indent=2))
+
+        report = {"timestamp": dt.datetime.now().isoformat(), "config": args.config, "family": args.family,
+                  "corpus": args.corpus or f"synthetic ({args.docs} docs x {args.paragraphs} paragraphs, seed {args.seed})",
+                  "queries": len(queries), "llm_stub": {"first_token_delay": args.first_token_delay,
+                                                         "token_delay": args.token_delay, "tokens": args.tokens},
+                  "runs": runs}
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
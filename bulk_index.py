@@ -0,0 +1,212 @@
+"""
+Bulk offline indexing of a directory into the collection of a topic, e.g. to seed a new channel with thousands of papers.
+
+The files are sharded across `--workers` processes (spawned, CPU only). Each of them loads the embedder once,
+then loads, splits (with the splitter profile of the topic) and embeds groups of `--files-per-task` files,
+in batches of `--embed-batch-size` chunks.
+The main process is the only writer: it adds the embedded chunks to the collection in bulk and records
+every file in the manifest of the collection once all its chunks are written. The manifest is the checkpoint:
+a killed run started again skips the files that are already indexed (and unchanged) and redoes the others.
+
+Example:
+    python bulk_index.py papers/ --topic vrp --version luna-1 --workers 4 --embed-batch-size 256
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from rag import chunk_id, clean_text, get_model_version, initialize_component, parse_document
+
+_worker = {}
+
+
+def init_worker(embedder_config, threads):
+    # the threads of torch are split between the processes instead of each using every core
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["MKL_NUM_THREADS"] = str(threads)
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    _worker["embedder"] = initialize_component(embedder_config)
+
+
+def index_files(paths, text_splitter_config, loaders_config, batch_size):
+    """
+    Loads, splits and embeds files in a worker process.
+    Returns ([(path, chunk ids, error)], ids, texts, metadatas, vectors, seconds).
+    """
+    start = time.perf_counter()
+    text_splitter = text_splitter_for(text_splitter_config)
+    # a SemanticSplitter embeds the sentences, the vectors of its chunks are used as they are
+    semantic = hasattr(text_splitter, 'split_documents_with_embeddings')
+    files, ids, texts, metadatas, vectors = [], [], [], [], []
+    for path in paths:
+        try:
+            if semantic:
+                chunks, chunk_vectors = text_splitter.split_documents_with_embeddings(parse_document(path, None, loaders_config))
+            else:
+                chunks, chunk_vectors = parse_document(path, text_splitter_config, loaders_config), None
+            chunk_ids = [chunk_id(chunk) for chunk in chunks]
+            files.append((path, chunk_ids, None))
+        except Exception as e:
+            files.append((path, [], str(e)))
+            continue
+        for id_, chunk in zip(chunk_ids, chunks):
+            ids.append(id_)
+            texts.append(chunk.page_content)
+            metadatas.append({**chunk.metadata, "snippet": clean_text(chunk.page_content)})
+        vectors.extend(chunk_vectors or [None] * len(chunks))
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        for j, vector in zip(batch, _worker["embedder"].embed_documents([texts[j] for j in batch])):
+            vectors[j] = vector
+    return files, ids, texts, metadatas, vectors, time.perf_counter() - start
+
+
+def text_splitter_for(text_splitter_config):
+    # built once per process
+    if "text_splitter" not in _worker:
+        text_splitter = initialize_component(text_splitter_config)
+        if hasattr(text_splitter, 'split_documents_with_embeddings') and text_splitter.embedder is None:
+            text_splitter.embedder = _worker["embedder"]
+        _worker["text_splitter"] = text_splitter
+    return _worker["text_splitter"]
+
+
+def find_files(directory, model):
+    paths = []
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if model.loaders.supports(path):
+                paths.append(path)
+    return sorted(paths)
+
+
+def embedder_config(model, batch_size):
+    config = json.loads(json.dumps(model.embedder_config))
+    if config['class'] == 'HuggingFaceEmbeddings':
+        # no GPU, and the batches of sentence-transformers as large as ours
+        config.setdefault('params', {}).setdefault('model_kwargs', {})['device'] = 'cpu'
+        config['params'].setdefault('encode_kwargs', {})['batch_size'] = batch_size
+    return config
+
+
+class Progress:
+
+    def __init__(self, files_total, interval=5.0):
+        self.files_total = files_total
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+        self.files = self.chunks = self.written = self.failed = 0
+        self.worker_seconds = self.write_seconds = 0.0
+
+    def rates(self):
+        elapsed = time.perf_counter() - self.start
+        return {"files": self.files, "files_total": self.files_total, "failed": self.failed, "chunks": self.chunks,
+                "chunks_written": self.written, "seconds": elapsed,
+                "docs_per_s": self.files / elapsed if elapsed else 0.0,
+                "chunks_per_s": self.chunks / elapsed if elapsed else 0.0,
+                "worker_seconds": self.worker_seconds, "write_seconds": self.write_seconds}
+
+    def report(self, force=False):
+        now = time.perf_counter()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            rates = self.rates()
+            print(f"{rates['files']}/{rates['files_total']} files, {rates['chunks']} chunks ({rates['chunks_written']} new) "
+                  f"in {rates['seconds']:.0f}s: {rates['docs_per_s']:.1f} docs/s, {rates['chunks_per_s']:.1f} chunks/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index a directory into the collection of a topic")
+    parser.add_argument("directory")
+    parser.add_argument("--topic", required=True)
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--family", default="CohereModels")
+    parser.add_argument("--version", default=os.getenv("LUNA_MODEL_VERSION", "luna-1"))
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="number of processes")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads per process, cores / workers by default")
+    parser.add_argument("--files-per-task", type=int, default=16)
+    parser.add_argument("--embed-batch-size", type=int, default=256)
+    parser.add_argument("--write-batch-size", type=int, default=4096, help="chunks per write to the collection")
+    parser.add_argument("--output", default=None, help="write the final report as JSON to this file")
+    args = parser.parse_args()
+
+    model = get_model_version(args.config, args.family, args.version)
+    topic = model.format_topic(args.topic)
+    if topic not in model.CHANNELS:
+        model.add_channel(topic)
+    paths = find_files(args.directory, model)
+    # the checkpoint: files indexed by a previous run (or through the app) are skipped if they are unchanged
+    todo = {}
+    for path in paths:
+        changed, file_content_hash, previous_ids = model.file_changed(path, topic)
+        if changed:
+            todo[path] = (file_content_hash, previous_ids)
+    print(f"{len(paths)} files in {args.directory}, {len(paths) - len(todo)} already indexed in {topic}, {len(todo)} to index")
+    if not todo:
+        return
+
+    progress = Progress(len(todo))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    pending_files, buffer = [], ([], [], [], [])
+
+    def flush():
+        ids, texts, metadatas, vectors = buffer
+        start = time.perf_counter()
+        progress.written += model.add_embeddings_to_vectorstore(ids, texts, metadatas, vectors, topic=topic)
+        # the files are only recorded once all their chunks are in the collection
+        for path, chunk_ids in pending_files:
+            model.commit_file(path, topic, *todo[path], chunk_ids)
+        model.save_topic(topic)
+        progress.write_seconds += time.perf_counter() - start
+        pending_files.clear()
+        for values in buffer:
+            values.clear()
+
+    groups = list(todo)
+    groups = [groups[i:i + args.files_per_task] for i in range(0, len(groups), args.files_per_task)]
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker, initargs=(embedder_config(model, args.embed_batch_size), threads)) as pool:
+        running = set()
+        while groups or running:
+            # at most two groups per process in flight, so that the embedded chunks don't pile up in memory
+            while groups and len(running) < 2 * args.workers:
+                running.add(pool.submit(index_files, groups.pop(0), model.text_splitter_config_for(topic), model.loaders_config,
+                                        args.embed_batch_size))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, ids, texts, metadatas, vectors, seconds = future.result()
+                progress.worker_seconds += seconds
+                for path, chunk_ids, error in files:
+                    progress.files += 1
+                    if error:
+                        progress.failed += 1
+                        print(f"Failed to index {path}: {error}")
+                    else:
+                        pending_files.append((path, chunk_ids))
+                for values, new in zip(buffer, (ids, texts, metadatas, vectors)):
+                    values.extend(new)
+                progress.chunks += len(ids)
+                if len(buffer[0]) >= args.write_batch_size:
+                    flush()
+            progress.report()
+    flush()
+    progress.report(force=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"topic": topic, "directory": args.directory, "workers": args.workers, "threads": threads,
+                       **progress.rates()}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
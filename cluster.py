@@ -0,0 +1,115 @@
+"""
+Shared state of a multi-worker deployment, kept in Redis so that any worker (on any node) can serve any request:
+
+- the channels (RedisChannelStore), instead of the `channels` list of config.yml
+- the status of the ingestion jobs and the queue of jobs waiting for the writer (RedisJobStore)
+- the notifications that a collection changed (CollectionEvents), so that the workers reopen it
+
+The chat history is stored with history_store.RedisHistoryStore and the Socket.IO events are relayed
+between the workers through the same Redis server (SocketIO(message_queue=...)).
+"""
+import json
+import os
+import threading
+import time
+
+
+def redis_client(url):
+    import redis
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+class RedisChannelStore:
+    """
+    Channels of a model version, in the order they were created.
+    """
+
+    def __init__(self, client, model_version, prefix="luna"):
+        self.client = client
+        self.key = f"{prefix}:channels:{model_version}"
+
+    def seed(self, channels):
+        # the channels of config.yml, on the first start of the deployment
+        if channels and not self.client.exists(self.key):
+            self.client.zadd(self.key, {channel: i for i, channel in enumerate(channels)}, nx=True)
+
+    def channels(self):
+        return self.client.zrange(self.key, 0, -1)
+
+    def add(self, channel):
+        """
+        Adds a channel unless it already exists. Returns whether it was added.
+        """
+        return bool(self.client.zadd(self.key, {channel: time.time()}, nx=True))
+
+
+class RedisJobStore:
+    """
+    Status of the ingestion jobs (IngestionJob.to_dict, kept for `ttl` seconds) and the queue of the jobs
+    submitted by the web workers, consumed by the single writer (ingestion_worker.py).
+    """
+
+    def __init__(self, client, prefix="luna", ttl=7 * 24 * 3600):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.queue_key = f"{prefix}:ingestion:queue"
+
+    def save(self, job):
+        self.client.set(f"{self.prefix}:ingestion:job:{job['job_id']}", json.dumps(job), ex=self.ttl)
+
+    def get(self, job_id):
+        job = self.client.get(f"{self.prefix}:ingestion:job:{job_id}")
+        return json.loads(job) if job else None
+
+    def enqueue(self, job_id, paths, topic, sid=None):
+        self.client.rpush(self.queue_key, json.dumps({"job_id": job_id, "paths": paths, "topic": topic, "sid": sid}))
+
+    def dequeue(self, timeout=5):
+        """
+        Next submitted job ({"job_id", "paths", "topic", "sid"}), or None after `timeout` seconds without one.
+        """
+        item = self.client.blpop(self.queue_key, timeout=timeout)
+        return json.loads(item[1]) if item else None
+
+
+class CollectionEvents:
+    """
+    Published by the writer once the chunks of a topic are written (and the index saved), so that the other
+    workers drop their open handle of the collection and read the new chunks.
+    """
+
+    def __init__(self, client, prefix="luna"):
+        self.client = client
+        self.channel = f"{prefix}:collections"
+        self._lock = threading.Lock()
+        self._threads = {} # pid -> listening thread
+
+    def publish(self, topic):
+        self.client.publish(self.channel, topic)
+
+    def subscribe(self, callback):
+        """
+        Calls `callback(topic)` for every change, from a daemon thread. The thread is started once per process:
+        call it again in a forked process (e.g. a worker of gunicorn --preload), which doesn't inherit it.
+        """
+        def listen():
+            while True:
+                try:
+                    pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                    for message in pubsub.listen():
+                        try:
+                            callback(message["data"])
+                        except Exception as e:
+                            print(f"Failed to handle the change of {message['data']}: {e}")
+                except Exception as e:
+                    print(f"Lost the subscription to {self.channel}: {e}, retrying")
+                    time.sleep(1)
+
+        with self._lock:
+            thread = self._threads.get(os.getpid())
+            if thread is None:
+                thread = self._threads[os.getpid()] = threading.Thread(target=listen, name="collection-events", daemon=True)
+                thread.start()
+        return thread
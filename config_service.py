@@ -0,0 +1,201 @@
+import json
+import os
+import string
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import yaml
+
+
+@contextmanager
+def file_lock(path, timeout=10, stale_after=30):
+    """
+    Inter-process lock on `path`, held through the existence of `path`.lock (works the same on Windows and POSIX).
+    A lock file older than `stale_after` seconds is considered left over by a crashed process and removed.
+    """
+    lock_path = f"{path}.lock"
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_after:
+                    os.remove(lock_path)
+                    continue
+            except FileNotFoundError:
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not lock {path}")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(lock_path)
+
+
+# read once, at import: setting the umask to read it is not thread-safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def write_atomic(path, text):
+    """
+    Writes a temp file next to `path` and renames it over `path`, so readers see the old or the new file, never half of it.
+    The file keeps the mode of the one it replaces (or gets the default one of a new file), not the 0600 of mkstemp.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            if hasattr(os, "fchmod"):
+                os.fchmod(file.fileno(), mode)
+            else:
+                # Windows, where only the read-only flag is kept
+                os.chmod(temp_path, mode)
+            file.write(text)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class PromptTemplate:
+    """
+    A prompt parsed once into its literal parts and fields. Fields given at compile time (e.g. the expertise of
+    the topic) are filled in right away, so rendering a request is a single join.
+    """
+
+    def __init__(self, template, **values):
+        self.parts = [] # literal text or (field name,)
+        for literal, field, _, _ in string.Formatter().parse(template):
+            if literal:
+                self.parts.append(literal)
+            if field is None:
+                continue
+            if field in values:
+                self.parts.append(str(values[field]))
+            else:
+                self.parts.append((field,))
+        # merge the consecutive literal parts
+        merged = []
+        for part in self.parts:
+            if isinstance(part, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += part
+            else:
+                merged.append(part)
+        self.parts = merged
+
+    def render(self, **values):
+        return "".join(part if isinstance(part, str) else str(values.get(part[0], "")) for part in self.parts)
+
+
+class ConfigService:
+    """
+    config.yml and prompts.json, loaded once and reloaded when their mtime changes (checked at most every
+    `check_interval` seconds), with the prompt of every (model version, topic) compiled once per version of the files.
+    Channels are added under a lock file and written with a rename, so concurrent workers don't lose
+    each other's channels and readers never see a half-written file.
+    """
+
+    def __init__(self, yaml_file="config.yml", prompts_file="prompts.json", check_interval=2.0):
+        self.yaml_file = yaml_file
+        self.prompts_file = prompts_file
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._files = {} # path -> (mtime, data)
+        self._templates = {}
+        self._last_check = 0.0
+        self.reloads = 0
+
+    def config(self):
+        return self._load(self.yaml_file, self._read_yaml) if self.yaml_file else {}
+
+    def model_config(self, model_family, model_version):
+        return self.config()['models'][model_family][model_version]
+
+    def prompts(self):
+        return self._load(self.prompts_file, self._read_json) if self.prompts_file and os.path.exists(self.prompts_file) else {}
+
+    def channels(self, model_family, model_version):
+        return list(self.model_config(model_family, model_version).get('channels') or [])
+
+    def prompt(self, template, topic):
+        """
+        Compiled prompt of a topic: `template` (the prompt of the model version) with the expertise of the topic from prompts.json.
+        """
+        self._check()
+        key = (template, topic)
+        compiled = self._templates.get(key)
+        if compiled is None:
+            compiled = PromptTemplate(template, expertise=self.prompts().get(topic) or "")
+            with self._lock:
+                self._templates[key] = compiled
+        return compiled
+
+    def add_channel(self, model_family, model_version, channel):
+        """
+        Appends a channel to a model version in config.yml, unless it is already there. Returns the channels.
+        """
+        with self._lock, file_lock(self.yaml_file):
+            # read the file again under the lock, another worker may have added channels since it was cached
+            with open(self.yaml_file, 'r') as file:
+                data = yaml.safe_load(file)
+            model_config = data['models'][model_family][model_version]
+            channels = model_config.setdefault('channels', [])
+            if channel not in channels:
+                channels.append(channel)
+                write_atomic(self.yaml_file, yaml.dump(data, default_flow_style=False))
+            self._files.pop(self.yaml_file, None)
+            return list(channels)
+
+    def _check(self):
+        # stat the files at most every check_interval seconds
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        for path in (self.yaml_file, self.prompts_file):
+            cached = self._files.get(path)
+            if cached and self._mtime(path) != cached[0]:
+                with self._lock:
+                    self._files.pop(path, None)
+                    self._templates.clear()
+                    self.reloads += 1
+                print(f"{path} changed, reloading it")
+
+    def _load(self, path, read):
+        self._check()
+        cached = self._files.get(path)
+        if cached is None:
+            with self._lock:
+                cached = self._files.get(path)
+                if cached is None:
+                    mtime = self._mtime(path)
+                    cached = self._files[path] = (mtime, read(path))
+        return cached[1]
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _read_yaml(path):
+        with open(path, 'r') as file:
+            return yaml.load(file, Loader=yaml.FullLoader)
+
+    @staticmethod
+    def _read_json(path):
+        with open(path, 'r') as file:
+            return json.load(file)
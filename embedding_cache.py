@@ -0,0 +1,97 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class SQLiteEmbeddingCache(Embeddings):
+    """
+    Content-addressed, persistent cache in front of an embedder.
+    Vectors are stored in SQLite keyed by the hash of the embedder model name and the chunk text,
+    so re-ingesting the same text only costs a disk lookup.
+    """
+
+    def __init__(self, embedder, path, namespace=None):
+        self.embedder = embedder
+        self.path = path
+        self.namespace = namespace or getattr(embedder, "model_name", type(embedder).__name__)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connections = {} # pid -> connection
+
+    @property
+    def _connection(self):
+        # opened on first use in each process (used under self._lock): a forked worker (gunicorn --preload) opens
+        # its own, the one it inherited is kept unused, closing it would release the locks of the new one
+        connection = self._connections.get(os.getpid())
+        if connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            connection.commit()
+            self._connections[os.getpid()] = connection
+        return connection
+
+    def __getattr__(self, name):
+        # behave like the wrapped embedder for anything else (e.g. model_name)
+        if name == "embedder":
+            raise AttributeError(name)
+        return getattr(self.embedder, name)
+
+    def key(self, text):
+        return content_hash(self.namespace, text)
+
+    def embed_documents(self, texts):
+        keys = [self.key(text) for text in texts]
+        cached = self._get_many(set(keys))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            vectors = self.embedder.embed_documents(list(missing.values()))
+            new = dict(zip(missing.keys(), vectors))
+            self._put_many(new)
+            cached.update(new)
+        return [list(cached[key]) for key in keys]
+
+    def embed_query(self, text):
+        return self.embedder.embed_query(text)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def _get_many(self, keys):
+        found = {}
+        keys = list(keys)
+        with self._lock:
+            # stay below SQLite's limit of host parameters per statement
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch)
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def _put_many(self, vectors):
+        rows = [(key, array("f", vector).tobytes()) for key, vector in vectors.items()]
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+            self._connection.commit()
@@ -0,0 +1,307 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from langchain_core.documents import Document
+
+
+def index_factory_string(index_type="flat", quantization=None, nlist=1024, pq_m=16, hnsw_m=32):
+    """
+    FAISS index factory string of an index type ("flat", "ivf", "hnsw") and a quantization (None, "int8", "pq").
+    """
+    codec = {None: "Flat", "int8": "SQ8", "pq": f"PQ{pq_m}"}.get(quantization)
+    if codec is None:
+        raise ValueError(f"Unknown quantization: {quantization}")
+    if index_type == "flat":
+        return codec
+    if index_type == "ivf":
+        return f"IVF{nlist},{codec}"
+    if index_type == "hnsw":
+        return f"HNSW{hnsw_m},{codec}"
+    raise ValueError(f"Unknown index type: {index_type}")
+
+
+class FaissRetriever:
+
+    def __init__(self, store, k=20):
+        self.store = store
+        self.k = k
+
+    def invoke(self, query):
+        return self.store.similarity_search(query, k=self.k)
+
+
+class FaissVectorStore:
+    """
+    Collection stored in a FAISS index instead of Chroma, selected with the `vector_index` entry of a model version.
+    It implements the part of the Chroma collection (get, delete, count) and vectorstore (add_documents,
+    similarity_search_by_vector) APIs used by rag.py, so it is returned as both by MyRAGModel.get_vectorstore.
+
+    - {path}.faiss holds the vectors (cosine similarity), memory-mapped when `mmap` is set so that a large
+      collection doesn't have to fit in RAM. Writes go to an in-memory copy, saved every `save_interval` seconds.
+    - {path}.sqlite holds the ids, texts and metadata of the chunks and is the reference: on open, the chunks
+      added after the last save of the index are embedded again (from the embedding cache, usually) and added.
+    - IVF and PQ indexes need training: vectors are kept in a flat index until `train_size` of them are available.
+    - The ids of the index are the faiss_id of the chunks. IVF indexes store them in their inverted lists; the other
+      indexes are wrapped in an IndexIDMap2, whose removal is only consistent with indexes that compact their
+      vectors on removal (flat, SQ8, PQ). HNSW can't remove vectors: the deleted ones are filtered out of the results.
+    - With `read_only` (the web workers of a multi-worker deployment, whose collections are written by a single
+      writer) an existing collection is only read: the chunks missing from the index are not added, nothing is
+      saved and writes fail.
+    """
+
+    def __init__(self, path, embedder, index_type="flat", quantization=None, nlist=1024, nprobe=16, pq_m=16,
+                 hnsw_m=32, ef_search=64, train_size=None, mmap=True, save_interval=60, dimension=None,
+                 read_only=False):
+        import faiss
+        import numpy as np
+        self.faiss = faiss
+        self.np = np
+        self.path = path
+        self.embedder = embedder
+        self.factory = index_factory_string(index_type, quantization, nlist, pq_m, hnsw_m)
+        self.index_type = index_type
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        if train_size is None:
+            train_size = max(39 * nlist if index_type == "ivf" else 0, 39 * 256 if quantization == "pq" else 0,
+                             1000 if quantization == "int8" else 0)
+        self.train_size = train_size
+        self.mmap = mmap
+        self.save_interval = save_interval
+        self.dimension = dimension
+        self.read_only = read_only
+        self._lock = threading.RLock()
+        if read_only:
+            self._connection = sqlite3.connect(f"file:{path}.sqlite?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._connection = sqlite3.connect(f"{path}.sqlite", check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS chunks (faiss_id INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL,
+                                                   document TEXT NOT NULL, metadata TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """)
+            self._connection.commit()
+        self.index = None
+        self._index_up_to = 0 # highest faiss id added to the index
+        self._writable = False
+        self._dirty = False
+        self._last_save = time.monotonic()
+        self._open()
+
+    def __len__(self):
+        return self.count()
+
+    def count(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def get(self, ids=None, include=("documents", "metadatas"), limit=None, offset=None):
+        with self._lock:
+            if ids is not None:
+                rows = []
+                ids = list(ids)
+                for i in range(0, len(ids), 500):
+                    batch = ids[i:i + 500]
+                    rows.extend(self._connection.execute(
+                        f"SELECT id, document, metadata FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch))
+            else:
+                rows = self._connection.execute("SELECT id, document, metadata FROM chunks ORDER BY faiss_id LIMIT ? OFFSET ?",
+                                                (-1 if limit is None else limit, offset or 0)).fetchall()
+        result = {"ids": [row[0] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [row[1] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(row[2]) for row in rows]
+        return result
+
+    def delete(self, ids):
+        self._check_writable()
+        with self._lock:
+            faiss_ids = self._faiss_ids(ids)
+            if not faiss_ids:
+                return
+            self._connection.executemany("DELETE FROM chunks WHERE id = ?", [(id_,) for id_ in ids])
+            self._connection.commit()
+            self._make_writable()
+            try:
+                self.index.remove_ids(self.np.array(faiss_ids, dtype="int64"))
+            except RuntimeError:
+                # HNSW indexes don't support removal, the vectors stay and are filtered out of the results
+                self._tombstones += len(faiss_ids)
+                self._set_state("tombstones", self._tombstones)
+            self._changed()
+
+    def add_documents(self, documents, ids):
+        vectors = self.embedder.embed_documents([doc.page_content for doc in documents])
+        self.add_embeddings(ids, [doc.page_content for doc in documents], [doc.metadata for doc in documents], vectors)
+
+    def add_embeddings(self, ids, texts, metadatas, vectors):
+        self._check_writable()
+        with self._lock:
+            existing = set(self.get(ids=ids, include=())["ids"])
+            rows = [(id_, text, json.dumps(metadata or {})) for id_, text, metadata in zip(ids, texts, metadatas) if id_ not in existing]
+            keep = [i for i, id_ in enumerate(ids) if id_ not in existing]
+            if not rows:
+                return
+            self._connection.executemany("INSERT OR IGNORE INTO chunks (id, document, metadata) VALUES (?, ?, ?)", rows)
+            self._connection.commit()
+            self._add_vectors(self._as_array([vectors[i] for i in keep]), self._faiss_ids([row[0] for row in rows]))
+            self._changed()
+
+    def similarity_search(self, query, k=20):
+        return self.similarity_search_by_vector(self.embedder.embed_query(query), k=k)
+
+    def similarity_search_by_vector(self, embedding, k=20):
+        with self._lock:
+            _, found = self.index.search(self._as_array([embedding]), k + min(self._tombstones, 3 * k))
+            faiss_ids = [int(faiss_id) for faiss_id in found[0] if faiss_id >= 0]
+            if not faiss_ids:
+                return []
+            rows = self._connection.execute(
+                f"SELECT faiss_id, document, metadata FROM chunks WHERE faiss_id IN ({','.join('?' * len(faiss_ids))})", faiss_ids)
+            by_id = {faiss_id: Document(page_content=document, metadata=json.loads(metadata)) for faiss_id, document, metadata in rows}
+        return [by_id[faiss_id] for faiss_id in faiss_ids if faiss_id in by_id][:k]
+
+    def as_retriever(self, search_kwargs=None, **kwargs):
+        return FaissRetriever(self, k=(search_kwargs or {}).get("k", 20))
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or self.read_only:
+                return
+            self.faiss.write_index(self.index, f"{self.path}.faiss.tmp")
+            os.replace(f"{self.path}.faiss.tmp", f"{self.path}.faiss")
+            self._set_state("index_up_to", self._index_up_to)
+            self._dirty = False
+            self._last_save = time.monotonic()
+            if self.mmap:
+                # the in-memory copy is dropped and the index is mapped from disk again
+                self._load(mmap=True)
+
+    def close(self):
+        with self._lock:
+            self.save()
+            self._connection.close()
+
+    def _open(self):
+        if os.path.exists(f"{self.path}.faiss"):
+            self._load(mmap=self.mmap)
+        # chunks written to SQLite after the last save of the index (e.g. before a crash)
+        self._index_up_to = self._get_state("index_up_to", 0)
+        self._tombstones = self._get_state("tombstones", 0)
+        if not self.read_only and isinstance(self.index, self.faiss.IndexIDMap) and isinstance(self._inner(), self.faiss.IndexIVF):
+            # saved by a version that wrapped IVF indexes in an id map, whose deletes corrupted it: built again
+            print(f"Rebuilding {self.path}.faiss...")
+            self.index, self._index_up_to, self._tombstones = None, 0, 0
+            self._set_state("tombstones", 0)
+        if self.index is None:
+            self._new_index()
+        if self.read_only:
+            # they are searchable once the writer has added them and saved the index
+            return
+        rows = self._connection.execute("SELECT faiss_id, document FROM chunks WHERE faiss_id > ? ORDER BY faiss_id",
+                                        (self._index_up_to,)).fetchall()
+        if rows:
+            print(f"Adding {len(rows)} chunks missing from {self.path}.faiss...")
+            for i in range(0, len(rows), 256):
+                batch = rows[i:i + 256]
+                self._add_vectors(self._as_array(self.embedder.embed_documents([row[1] for row in batch])), [row[0] for row in batch])
+            self._changed(force_save=True)
+
+    def _load(self, mmap):
+        flags = self.faiss.IO_FLAG_MMAP if mmap else 0
+        self.index = self.faiss.read_index(f"{self.path}.faiss", flags)
+        self._writable = not mmap
+        self._tune()
+
+    def _new_index(self):
+        index = self.faiss.index_factory(self._dimension(), self.factory, self.faiss.METRIC_INNER_PRODUCT)
+        if not index.is_trained:
+            # until there are enough vectors to train the index on
+            index = self.faiss.IndexFlatIP(index.d)
+        self.index = self._with_ids(index)
+        self._writable = True
+        self._tune()
+
+    def _with_ids(self, index):
+        # IndexIDMap2.remove_ids assumes that the wrapped index renumbers its vectors like a flat index does,
+        # an IVF index doesn't: it would map the results to the ids of other (or deleted) chunks
+        if isinstance(self.faiss.downcast_index(index), self.faiss.IndexIVF):
+            return index
+        return self.faiss.IndexIDMap2(index)
+
+    def _inner(self):
+        # the index without its id map
+        index = self.index.index if isinstance(self.index, self.faiss.IndexIDMap) else self.index
+        return self.faiss.downcast_index(index)
+
+    def _dimension(self):
+        if self.dimension is None:
+            self.dimension = len(self.embedder.embed_query("dimension"))
+        return self.dimension
+
+    def _tune(self):
+        inner = self._inner()
+        if hasattr(inner, "nprobe"):
+            inner.nprobe = self.nprobe
+        if hasattr(inner, "hnsw"):
+            inner.hnsw.efSearch = self.ef_search
+
+    def _check_writable(self):
+        if self.read_only:
+            raise RuntimeError(f"{self.path} is opened read-only")
+
+    def _make_writable(self):
+        if not self._writable:
+            # memory-mapped indexes are read-only
+            self._load(mmap=False)
+
+    def _add_vectors(self, vectors, faiss_ids):
+        self._make_writable()
+        self.index.add_with_ids(vectors, self.np.array(faiss_ids, dtype="int64"))
+        self._index_up_to = max(self._index_up_to, max(faiss_ids))
+        if isinstance(self._inner(), self.faiss.IndexFlatIP) and self.factory != "Flat" and self.index.ntotal >= self.train_size:
+            self._train()
+
+    def _train(self):
+        # moves the vectors kept in the flat index to the trained index
+        ids = self.faiss.vector_to_array(self.index.id_map).astype("int64")
+        vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+        index = self.faiss.index_factory(vectors.shape[1], self.factory, self.faiss.METRIC_INNER_PRODUCT)
+        print(f"Training {self.factory} index on {len(vectors)} vectors...")
+        index.train(vectors)
+        self.index = self._with_ids(index)
+        self.index.add_with_ids(vectors, ids)
+        self._tune()
+
+    def _changed(self, force_save=False):
+        self._dirty = True
+        if force_save or time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def _as_array(self, vectors):
+        array = self.np.asarray(vectors, dtype="float32")
+        self.faiss.normalize_L2(array)
+        return array
+
+    def _faiss_ids(self, ids):
+        # in the order of `ids`, unknown ids are skipped
+        ids = list(ids)
+        found = {}
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            found.update(self._connection.execute(f"SELECT id, faiss_id FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch))
+        return [found[id_] for id_ in ids if id_ in found]
+
+    def _get_state(self, key, default=None):
+        row = self._connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_state(self, key, value):
+        self._connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        self._connection.commit()
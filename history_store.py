@@ -0,0 +1,298 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class HistoryStore:
+    """
+    Storage of the chat history: users -> rooms -> conversations -> messages.
+    Messages are appended one at a time and conversations are read individually,
+    so the cost of a write doesn't depend on the size of the whole history.
+    """
+
+    def add_room(self, user, room):
+        raise NotImplementedError
+
+    def add_conversation(self, user, room, conversation_id):
+        raise NotImplementedError
+
+    def append(self, user, room, conversation_id, message):
+        raise NotImplementedError
+
+    def get_messages(self, user, room, conversation_id):
+        raise NotImplementedError
+
+    def get_conversations(self, user):
+        raise NotImplementedError
+
+    def is_empty(self):
+        raise NotImplementedError
+
+    def compact(self):
+        pass
+
+    def close(self):
+        pass
+
+    def import_legacy(self, chat_history):
+        # chat_history.json format: {user: {room: {conversation_id: [messages]}}}
+        for user, rooms in chat_history.items():
+            for room, conversations in rooms.items():
+                self.add_room(user, room)
+                if not isinstance(conversations, dict):
+                    continue
+                for conversation_id, messages in conversations.items():
+                    self.add_conversation(user, room, conversation_id)
+                    for message in messages:
+                        self.append(user, room, conversation_id, message)
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    Every `compact_every` appends the WAL is checkpointed and truncated, so that it doesn't keep growing while
+    the history is being read and written all the time.
+    """
+
+    def __init__(self, path, compact_every=1000):
+        self.path = path
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._connections = {} # pid -> connection
+        self._appends = 0
+
+    @property
+    def _connection(self):
+        # per process, see SQLiteEmbeddingCache._connection
+        connection = self._connections.get(os.getpid())
+        if connection is None:
+            connection = self._connections[os.getpid()] = self._connect()
+        return connection
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS rooms (
+                user TEXT NOT NULL, room TEXT NOT NULL,
+                PRIMARY KEY (user, room)
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                user TEXT NOT NULL, room TEXT NOT NULL, conversation_id TEXT NOT NULL,
+                PRIMARY KEY (user, room, conversation_id)
+            );
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL, room TEXT NOT NULL, conversation_id TEXT NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_conversation ON messages (user, room, conversation_id);
+        """)
+        connection.commit()
+        return connection
+
+    def _execute(self, statement, params=()):
+        with self._lock:
+            rows = self._connection.execute(statement, params).fetchall()
+            self._connection.commit()
+        return rows
+
+    def add_room(self, user, room):
+        self._execute("INSERT OR IGNORE INTO rooms (user, room) VALUES (?, ?)", (user, room))
+
+    def add_conversation(self, user, room, conversation_id):
+        with self._lock:
+            self._connection.execute("INSERT OR IGNORE INTO rooms (user, room) VALUES (?, ?)", (user, room))
+            self._connection.execute("INSERT OR IGNORE INTO conversations (user, room, conversation_id) VALUES (?, ?, ?)",
+                                     (user, room, conversation_id))
+            self._connection.commit()
+
+    def append(self, user, room, conversation_id, message):
+        with self._lock:
+            self._connection.execute("INSERT INTO messages (user, room, conversation_id, message) VALUES (?, ?, ?, ?)",
+                                     (user, room, conversation_id, json.dumps(message)))
+            self._connection.commit()
+            self._appends += 1
+            compact = self.compact_every and self._appends >= self.compact_every
+            if compact:
+                self._appends = 0
+        if compact:
+            self.compact()
+
+    def get_messages(self, user, room, conversation_id):
+        rows = self._execute("SELECT message FROM messages WHERE user = ? AND room = ? AND conversation_id = ? ORDER BY id",
+                             (user, room, conversation_id))
+        return [json.loads(message) for message, in rows]
+
+    def get_conversations(self, user):
+        conversations = {room: [] for room, in self._execute("SELECT room FROM rooms WHERE user = ? ORDER BY rowid", (user,))}
+        for room, conversation_id in self._execute("SELECT room, conversation_id FROM conversations WHERE user = ? ORDER BY rowid", (user,)):
+            conversations.setdefault(room, []).append(conversation_id)
+        return conversations
+
+    def is_empty(self):
+        return not self._execute("SELECT 1 FROM rooms LIMIT 1")
+
+    def compact(self):
+        self._execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with self._lock:
+            connection = self._connections.pop(os.getpid(), None)
+            if connection is not None:
+                connection.close()
+
+
+class JSONLHistoryStore(HistoryStore):
+    """
+    Append-only log with one JSON record per line. Only the byte offsets of the messages are kept in memory.
+    Every `compact_every` appends the log is rewritten (temp file + rename) with the messages of each conversation
+    next to each other, so reading a conversation touches a contiguous part of the file.
+    """
+
+    def __init__(self, path, compact_every=10000):
+        self.path = path
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._index = {} # user -> room -> conversation_id -> [offsets]
+        self._appends = 0
+        if os.path.exists(path):
+            self._load_index()
+        self._file = open(path, "ab")
+
+    def _load_index(self):
+        with open(self.path, "rb") as file:
+            offset = 0
+            for line in file:
+                if line.endswith(b"\n"):
+                    self._index_record(json.loads(line), offset)
+                offset += len(line)
+
+    def _index_record(self, record, offset):
+        rooms = self._index.setdefault(record["user"], {})
+        conversations = rooms.setdefault(record["room"], {})
+        if record["op"] == "conversation":
+            conversations.setdefault(record["conversation_id"], [])
+        elif record["op"] == "message":
+            conversations.setdefault(record["conversation_id"], []).append(offset)
+
+    def _write(self, record):
+        with self._lock:
+            offset = self._file.tell()
+            self._file.write(json.dumps(record).encode("utf-8") + b"\n")
+            self._file.flush()
+            self._index_record(record, offset)
+            self._appends += 1
+            compact = self.compact_every and self._appends >= self.compact_every
+        if compact:
+            self.compact()
+
+    def add_room(self, user, room):
+        if room not in self._index.get(user, {}):
+            self._write({"op": "room", "user": user, "room": room})
+
+    def add_conversation(self, user, room, conversation_id):
+        if conversation_id not in self._index.get(user, {}).get(room, {}):
+            self._write({"op": "conversation", "user": user, "room": room, "conversation_id": conversation_id})
+
+    def append(self, user, room, conversation_id, message):
+        self._write({"op": "message", "user": user, "room": room, "conversation_id": conversation_id, "message": message})
+
+    def get_messages(self, user, room, conversation_id):
+        # read under the lock, the offsets are only valid until the next compaction rewrites the file
+        with self._lock:
+            offsets = self._index.get(user, {}).get(room, {}).get(conversation_id, [])
+            messages = []
+            with open(self.path, "rb") as file:
+                for offset in offsets:
+                    file.seek(offset)
+                    messages.append(json.loads(file.readline())["message"])
+        return messages
+
+    def get_conversations(self, user):
+        with self._lock:
+            return {room: list(conversations) for room, conversations in self._index.get(user, {}).items()}
+
+    def is_empty(self):
+        return not self._index
+
+    def compact(self):
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            index = {}
+            with open(self.path, "rb") as source, open(tmp_path, "wb") as target:
+                for user, rooms in self._index.items():
+                    index[user] = {}
+                    for room, conversations in rooms.items():
+                        target.write(json.dumps({"op": "room", "user": user, "room": room}).encode("utf-8") + b"\n")
+                        index[user][room] = {}
+                        for conversation_id, offsets in conversations.items():
+                            target.write(json.dumps({"op": "conversation", "user": user, "room": room,
+                                                     "conversation_id": conversation_id}).encode("utf-8") + b"\n")
+                            index[user][room][conversation_id] = []
+                            for offset in offsets:
+                                source.seek(offset)
+                                index[user][room][conversation_id].append(target.tell())
+                                target.write(source.readline())
+                target.flush()
+                os.fsync(target.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, "ab")
+            self._index = index
+            self._appends = 0
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class RedisHistoryStore(HistoryStore):
+    """
+    History shared by the workers of a multi-worker deployment. `path` is the URL of the Redis server.
+    Rooms and conversations are sorted sets (in creation order) and the messages of a conversation a list.
+    """
+
+    def __init__(self, path, prefix="luna:history"):
+        from cluster import redis_client
+        self.client = redis_client(path)
+        self.prefix = prefix
+
+    def add_room(self, user, room):
+        self.client.zadd(f"{self.prefix}:rooms:{user}", {room: time.time()}, nx=True)
+
+    def add_conversation(self, user, room, conversation_id):
+        pipeline = self.client.pipeline()
+        pipeline.zadd(f"{self.prefix}:rooms:{user}", {room: time.time()}, nx=True)
+        pipeline.zadd(f"{self.prefix}:conversations:{user}:{room}", {conversation_id: time.time()}, nx=True)
+        pipeline.execute()
+
+    def append(self, user, room, conversation_id, message):
+        self.client.rpush(f"{self.prefix}:messages:{user}:{room}:{conversation_id}", json.dumps(message))
+
+    def get_messages(self, user, room, conversation_id):
+        return [json.loads(message) for message in self.client.lrange(f"{self.prefix}:messages:{user}:{room}:{conversation_id}", 0, -1)]
+
+    def get_conversations(self, user):
+        rooms = self.client.zrange(f"{self.prefix}:rooms:{user}", 0, -1)
+        pipeline = self.client.pipeline()
+        for room in rooms:
+            pipeline.zrange(f"{self.prefix}:conversations:{user}:{room}", 0, -1)
+        return dict(zip(rooms, pipeline.execute()))
+
+    def is_empty(self):
+        return next(self.client.scan_iter(match=f"{self.prefix}:rooms:*", count=100), None) is None
+
+    def close(self):
+        self.client.close()
+
+
+def get_history_store(backend, path, **kwargs):
+    if backend == "sqlite":
+        return SQLiteHistoryStore(path, **kwargs)
+    elif backend == "jsonl":
+        return JSONLHistoryStore(path, **kwargs)
+    elif backend == "redis":
+        return RedisHistoryStore(path, **kwargs)
+    raise ValueError(f"Unknown history backend: {backend}")
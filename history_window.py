@@ -0,0 +1,103 @@
+import math
+
+from metrics import ERRORS
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text, good enough to keep a prompt within a budget
+    return max(1, math.ceil(len(text) / 4))
+
+
+class ChatHistoryWindow:
+    """
+    Chat history of a session, sent to the LLM within a token budget.
+    The last turns are kept verbatim as long as they fit in `max_tokens` and `max_turns`. When the window
+    rolls, the turns that fall out of it are folded into a running summary with `summarize(summary, messages)`,
+    so the summary is only regenerated for the evicted turns and the evicted messages are not kept in memory.
+    """
+
+    def __init__(self, summarize=None, max_tokens=2000, max_turns=10, count_tokens=estimate_tokens):
+        self.summarize = summarize
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.count_tokens = count_tokens
+        self.messages = [] # {"role": "USER" | "CHATBOT", "text": ...}
+        self.summary = None
+        self._tokens = [] # token count of every message
+        self._summary_tokens = 0
+        self._evicted = 0
+
+    def __len__(self):
+        return self._evicted + len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def append(self, role, text):
+        self.messages.append({"role": role, "text": text})
+        self._tokens.append(self.count_tokens(text))
+
+    def window(self, max_tokens=None):
+        """
+        Returns the chat history to send along with the current question: the summary (as a SYSTEM message)
+        followed by the last turns. A trailing USER message is the current question and is left out.
+        """
+        max_tokens = max_tokens or self.max_tokens
+        end = len(self.messages) - 1 if self.messages and self.messages[-1]["role"] == "USER" else len(self.messages)
+        start = self._window_start(end, max_tokens - self._summary_tokens)
+        if start > 0:
+            self._roll(start)
+            end -= start
+            # the new summary may be longer than the previous one
+            start = self._window_start(end, max_tokens - self._summary_tokens)
+            if start > 0:
+                self._roll(start)
+                end -= start
+        history = [{"role": "SYSTEM", "text": f"Summary of the earlier conversation: {self.summary}"}] if self.summary else []
+        previous_role = None
+        for message in self.messages[:end]:
+            # the API rejects two messages of the same role in a row (e.g. a question whose answer was cancelled)
+            if message["role"] == previous_role:
+                history[-1] = message
+            else:
+                history.append(message)
+            previous_role = message["role"]
+        return history
+
+    def clear(self):
+        self.messages, self._tokens = [], []
+        self.summary, self._summary_tokens, self._evicted = None, 0, 0
+
+    def _window_start(self, end, budget):
+        # index of the first message of the window, always the USER message of a turn
+        start = end
+        tokens = 0
+        turns = 0
+        for i in range(end - 1, -1, -1):
+            tokens += self._tokens[i]
+            if tokens > budget:
+                break
+            if self.messages[i]["role"] == "USER":
+                turns += 1
+                if turns > self.max_turns:
+                    break
+                start = i
+        else:
+            start = 0
+        return start
+
+    def _roll(self, start):
+        evicted = self.messages[:start]
+        if self.summarize:
+            try:
+                self.summary = self.summarize(self.summary, evicted)
+            except Exception as e:
+                ERRORS.inc(stage="summarize")
+                print(f"Error while summarizing the chat history: {e}")
+                # keep the beginning of the evicted messages rather than losing them
+                excerpt = " ".join(f"{m['role']}: {m['text'][:200]}" for m in evicted)
+                self.summary = (f"{self.summary} {excerpt}" if self.summary else excerpt)[-self.max_tokens * 2:]
+        self._summary_tokens = self.count_tokens(self.summary) if self.summary else 0
+        del self.messages[:start]
+        del self._tokens[:start]
+        self._evicted += start
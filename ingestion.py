@@ -0,0 +1,329 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from uuid import uuid4
+
+from rag import parse_document, chunk_id
+from metrics import timed, ERRORS
+
+
+def extract_zip(path):
+    """
+    Extracts an archive next to it and returns the directory. Members that would land outside of it are skipped.
+    """
+    directory = os.path.splitext(path)[0]
+    root = os.path.realpath(directory)
+    with zipfile.ZipFile(path) as archive:
+        for member in archive.infolist():
+            target = os.path.realpath(os.path.join(directory, member.filename))
+            if target == root or target.startswith(root + os.sep):
+                archive.extract(member, directory)
+    return directory
+
+
+class IngestionJob:
+    """
+    Progress of one batch of uploaded files that are being added to the collection of a topic.
+    """
+
+    def __init__(self, paths, topic, sid=None, job_id=None):
+        self.id = job_id or str(uuid4())
+        self.paths = list(paths)
+        self.topic = topic
+        self.sid = sid
+        self.status = "queued" # queued -> running -> done | failed
+        self.files_done = 0
+        self.chunks_total = 0
+        self.chunks_done = 0
+        self.pages_done = 0
+        self.files_unchanged = 0
+        self.errors = {}
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "topic": self.topic,
+            "status": self.status,
+            "files_total": len(self.paths),
+            "files_done": self.files_done,
+            "chunks_total": self.chunks_total,
+            "chunks_done": self.chunks_done,
+            "pages_done": self.pages_done,
+            "files_unchanged": self.files_unchanged,
+            "errors": self.errors,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionQueue:
+    """
+    Background ingestion of uploaded files.
+    Files are parsed and split in parallel worker processes, while a single thread embeds the chunks
+    and writes them to the vectorstore in batches of at least `batch_size` chunks.
+    Files larger than `stream_above_mb` are instead streamed page by page by the writer thread,
+    in micro-batches of `stream_batch_size` chunks, to cap the memory they need.
+    Files that are unchanged since they were last indexed in the topic are skipped, and the chunks
+    that a new version of a file no longer has are deleted.
+    """
+
+    def __init__(self, model, max_workers=None, batch_size=256, on_progress=None, max_finished_jobs=1000,
+                 stream_above_mb=None, stream_batch_size=64):
+        self.model = model
+        self.max_workers = max_workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.stream_above_mb = stream_above_mb
+        self.stream_batch_size = stream_batch_size
+        self.on_progress = on_progress
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._queue = None
+        self._pool = None
+        self._thread = None
+        self._pid = None # of the process the writer thread runs in
+
+    def submit(self, paths, topic, sid=None, job_id=None):
+        job = IngestionJob(paths, self.model.format_topic(topic), sid=sid, job_id=job_id)
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            self._forget_finished_jobs()
+            self._start()
+        self._queue.put(job)
+        self._notify(job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def status(self, job_id):
+        job = self.jobs.get(job_id)
+        return job.to_dict() if job else None
+
+    def shutdown(self, wait=True):
+        if self._pid != os.getpid():
+            return
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
+        self._pool.shutdown(wait=wait)
+
+    def _start(self):
+        # on the first job of each process rather than when the queue is created, e.g. at the import of the app
+        # in the master of gunicorn --preload, whose threads don't exist in the forked workers
+        if self._pid == os.getpid():
+            return
+        self._queue = queue.Queue()
+        self._pool = self._new_pool()
+        self._thread = threading.Thread(target=self._run, name="ingestion-writer", daemon=True)
+        self._thread.start()
+        self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                with timed("ingestion_job", files=len(job.paths)):
+                    self._process(job)
+            except Exception as e:
+                traceback.print_exc()
+                job.errors["_job"] = str(e)
+                job.status = "failed"
+            job.finished_at = time.time()
+            self._notify(job)
+
+    def _process(self, job):
+        job.status = "running"
+        job.paths = self._expand(job)
+        self._notify(job)
+        changed = {}
+        for path in job.paths:
+            try:
+                is_changed, content_hash, previous_ids = self.model.file_changed(path, job.topic)
+            except OSError as e:
+                self._fail(job, path, e)
+                job.files_done += 1
+                continue
+            if is_changed:
+                changed[path] = (content_hash, previous_ids)
+            else:
+                job.files_done += 1
+                job.files_unchanged += 1
+        streamed = [path for path in changed if self._should_stream(path)]
+        futures = {self._parse(path, job.topic): path for path in changed if path not in streamed}
+        # files whose chunks are waiting in the batch: (path, content hash, previous ids, chunk ids)
+        pending = []
+        # vectors of the chunks of the batch computed by the splitter, if it embeds (see MyRAGModel.split_and_embed)
+        embeddings = {}
+        # the large files are streamed here while the small ones are being parsed by the pool
+        for path in streamed:
+            self._stream(job, path)
+        batch = []
+        crashed = []
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                chunks = future.result()
+            except BrokenProcessPool:
+                # a worker died (e.g. a native parser crashed) and took the pending files with it
+                crashed.append(path)
+                continue
+            except Exception as e:
+                # a file that can't be parsed fails on its own, the rest of the job goes on
+                self._fail(job, path, e)
+                chunks = None
+            self._add_chunks(job, path, chunks, changed[path], batch, pending, embeddings)
+        # retry the files of a crashed pool one at a time, so that only the file responsible fails. They were all
+        # lost to the same crash: the pool is reset once, then again only after a file that crashes it on its own
+        if crashed:
+            self._reset_pool()
+        for path in crashed:
+            try:
+                chunks = self._parse(path, job.topic).result()
+            except BrokenProcessPool as e:
+                self._fail(job, path, e)
+                self._reset_pool()
+                chunks = None
+            except Exception as e:
+                self._fail(job, path, e)
+                chunks = None
+            self._add_chunks(job, path, chunks, changed[path], batch, pending, embeddings)
+        if batch:
+            self._write(job, batch, pending, embeddings)
+        job.status = "failed" if job.errors and job.chunks_done == 0 else "done"
+
+    def _parse(self, path, topic):
+        # a splitter that embeds the text is run by the writer thread, next to the embedder, on the loaded documents
+        text_splitter_config = None if self.model.embeds_when_splitting(topic) else self.model.text_splitter_config_for(topic)
+        return self._pool.submit(parse_document, path, text_splitter_config, self.model.loaders_config)
+
+    def _new_pool(self):
+        # spawn, so that the workers don't inherit the threads and model weights of the web server. A spawned worker
+        # still imports the main module of this process (as __mp_main__, before any initializer), which is why the
+        # server is started from run.py, whose imports are all under its __main__ guard, and not from app.py
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _reset_pool(self):
+        self._pool.shutdown(wait=False)
+        self._pool = self._new_pool()
+
+    def _add_chunks(self, job, path, chunks, version, batch, pending, embeddings):
+        job.files_done += 1
+        if chunks is not None and self.model.embeds_when_splitting(job.topic):
+            try:
+                chunks, chunk_embeddings = self.model.split_and_embed(chunks, topic=job.topic)
+                embeddings.update(chunk_embeddings or {})
+            except Exception as e:
+                self._fail(job, path, e)
+                chunks = None
+        if chunks is not None:
+            job.chunks_total += len(chunks)
+            batch.extend(chunks)
+            pending.append((path, *version, [chunk_id(chunk) for chunk in chunks]))
+        # whole files are written at once, so that every file of the batch can be committed to the manifest after it
+        if len(batch) >= self.batch_size:
+            self._write(job, batch, pending, embeddings)
+        self._notify(job)
+
+    def _fail(self, job, path, error):
+        print(f"Failed to parse {path}: {error}")
+        ERRORS.inc(stage="parse")
+        job.errors[os.path.basename(path)] = str(error)
+
+    def _expand(self, job):
+        """
+        Replaces the directories and .zip archives of the job with the supported files they contain.
+        """
+        paths = []
+        for path in job.paths:
+            if path.lower().endswith(".zip"):
+                path = extract_zip(path)
+            if not os.path.isdir(path):
+                paths.append(path)
+                continue
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    file_path = os.path.join(root, name)
+                    if self.model.loaders.supports(file_path):
+                        paths.append(file_path)
+                    else:
+                        job.errors[name] = "Unsupported file type"
+        return paths
+
+    def _should_stream(self, path):
+        return self.stream_above_mb is not None and os.path.getsize(path) > self.stream_above_mb * 1024 * 1024
+
+    def _stream(self, job, path):
+        last = {"pages": 0, "chunks": 0, "written": 0}
+
+        def on_page(pages, chunks, chunks_written):
+            job.pages_done += pages - last["pages"]
+            job.chunks_total += chunks - last["chunks"]
+            job.chunks_done += chunks_written - last["written"]
+            last.update(pages=pages, chunks=chunks, written=chunks_written)
+            self._notify(job)
+
+        try:
+            self.model.ingest_stream(path, topic=job.topic, batch_size=self.stream_batch_size, on_progress=on_page)
+        except Exception as e:
+            print(f"Failed to ingest {path}: {e}")
+            ERRORS.inc(stage="parse")
+            job.errors[os.path.basename(path)] = str(e)
+        job.files_done += 1
+        self._notify(job)
+
+    def _write(self, job, batch, pending, embeddings):
+        self.model.add_document_to_vectorstore(batch, topic=job.topic, embeddings=embeddings or None)
+        for path, content_hash, previous_ids, ids in pending:
+            self.model.commit_file(path, job.topic, content_hash, previous_ids, ids)
+        job.chunks_done += len(batch)
+        batch.clear()
+        pending.clear()
+        embeddings.clear()
+        self._notify(job)
+
+    def _notify(self, job):
+        if self.on_progress:
+            try:
+                self.on_progress(job)
+            except Exception as e:
+                print(f"Failed to report progress of ingestion job {job.id}: {e}")
+
+    def _forget_finished_jobs(self):
+        finished = [job for job in self.jobs.values() if job.finished_at is not None]
+        for job in sorted(finished, key=lambda job: job.finished_at)[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job.id]
+
+
+class RemoteIngestionQueue:
+    """
+    Ingestion queue of the web workers of a multi-worker deployment: the jobs are handed over to the single
+    writer process (ingestion_worker.py) through a RedisJobStore, which also holds their progress.
+    The uploaded files must be on storage that the writer can read.
+    """
+
+    def __init__(self, model, job_store):
+        self.model = model
+        self.job_store = job_store
+
+    def submit(self, paths, topic, sid=None):
+        job = IngestionJob(paths, self.model.format_topic(topic), sid=sid)
+        self.job_store.save(job.to_dict())
+        self.job_store.enqueue(job.id, job.paths, job.topic, sid)
+        return job
+
+    def status(self, job_id):
+        return self.job_store.get(job_id)
+
+    def shutdown(self, wait=True):
+        pass
@@ -0,0 +1,67 @@
+"""
+Single writer of the vector db in a multi-worker deployment.
+
+The web workers (app.py with LUNA_REDIS_URL set) only read the collections: the files they receive are queued
+in Redis and ingested here, one job at a time, by the same IngestionQueue as in a single process. The progress
+is stored in Redis for /upload/<job_id> and emitted to the clients through the Socket.IO message queue, and once
+a job is written the workers are told to reopen the collection of its topic.
+
+Run exactly one of these per vector db, with the same config and uploads folder as the web workers:
+    LUNA_REDIS_URL=redis://localhost:6379/0 python ingestion_worker.py
+    LUNA_REDIS_URL=redis://localhost:6379/0 gunicorn -w 4 --threads 64 app:app
+"""
+import argparse
+import os
+
+from flask_socketio import SocketIO
+
+from cluster import CollectionEvents, RedisChannelStore, RedisJobStore, redis_client
+from ingestion import IngestionQueue
+from rag import get_model_version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest the files queued by the web workers")
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--family", default="CohereModels")
+    parser.add_argument("--version", default=os.getenv("LUNA_MODEL_VERSION", "luna-1"))
+    parser.add_argument("--redis", default=os.getenv("LUNA_REDIS_URL", "redis://localhost:6379/0"))
+    args = parser.parse_args()
+
+    model = get_model_version(args.config, args.family, args.version)
+    client = redis_client(args.redis)
+    job_store = RedisJobStore(client)
+    events = CollectionEvents(client)
+    # emits to the clients of every web worker
+    socketio = SocketIO(message_queue=args.redis)
+    if model.hybrid_search.get('enabled'):
+        # the web workers only open the lexical indexes, the missing ones are built here
+        for topic in RedisChannelStore(client, model.model_name).channels():
+            model.get_lexical_index(topic)
+
+    def report_progress(job):
+        job_store.save(job.to_dict())
+        if job.finished_at is not None and job.files_done > job.files_unchanged:
+            model.save_topic(job.topic)
+            events.publish(job.topic)
+        socketio.emit('ingestion_progress', job.to_dict(), room=job.sid or job.topic)
+
+    queue = IngestionQueue(model, max_workers=model.ingestion_config.get('max_workers'),
+                           batch_size=model.ingestion_config.get('batch_size', 256),
+                           stream_above_mb=model.ingestion_config.get('stream_above_mb'),
+                           stream_batch_size=model.ingestion_config.get('stream_batch_size', 64),
+                           on_progress=report_progress)
+    print(f"Waiting for ingestion jobs on {args.redis}...")
+    try:
+        while True:
+            item = job_store.dequeue()
+            if item:
+                queue.submit(item["paths"], item["topic"], sid=item["sid"], job_id=item["job_id"])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import heapq
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN_PATTERN.findall(text)]
+
+
+class BM25Index:
+    """
+    Persistent inverted index of the chunks of one collection, scored with Okapi BM25.
+    It is stored in SQLite and updated incrementally, one chunk at a time, with the same ids as the Chroma collection.
+    With `read_only` an existing index is only searched (sqlite3.OperationalError if it doesn't exist).
+    """
+
+    def __init__(self, path, k1=1.5, b=0.75, read_only=False):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        if read_only:
+            self._connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._create()
+        self._n_documents, self._total_length = self._connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM documents").fetchone()
+
+    def _create(self):
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, length INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, id TEXT NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, id));
+            CREATE INDEX IF NOT EXISTS postings_id ON postings (id);
+        """)
+        self._connection.commit()
+
+    def __len__(self):
+        return self._n_documents
+
+    def add(self, ids, texts):
+        with self._lock:
+            existing = self._existing(ids)
+            for id_, text in zip(ids, texts):
+                if id_ in existing:
+                    continue
+                existing.add(id_)
+                tokens = tokenize(text)
+                self._connection.execute("INSERT INTO documents (id, length) VALUES (?, ?)", (id_, len(tokens)))
+                self._connection.executemany("INSERT INTO postings (term, id, tf) VALUES (?, ?, ?)",
+                                             [(term, id_, tf) for term, tf in Counter(tokens).items()])
+                self._n_documents += 1
+                self._total_length += len(tokens)
+            self._connection.commit()
+
+    def delete(self, ids):
+        with self._lock:
+            for id_ in ids:
+                row = self._connection.execute("SELECT length FROM documents WHERE id = ?", (id_,)).fetchone()
+                if row is None:
+                    continue
+                self._connection.execute("DELETE FROM documents WHERE id = ?", (id_,))
+                self._connection.execute("DELETE FROM postings WHERE id = ?", (id_,))
+                self._n_documents -= 1
+                self._total_length -= row[0]
+            self._connection.commit()
+
+    def search(self, query, k=20):
+        """
+        Returns the ids of the `k` best matching chunks, best first.
+        """
+        terms = set(tokenize(query))
+        if not terms or not self._n_documents:
+            return []
+        with self._lock:
+            n_documents = self._n_documents
+            average_length = self._total_length / n_documents
+            scores = {}
+            for term in terms:
+                postings = self._connection.execute(
+                    "SELECT p.id, p.tf, d.length FROM postings p JOIN documents d ON d.id = p.id WHERE p.term = ?", (term,)).fetchall()
+                if not postings:
+                    continue
+                idf = math.log((n_documents - len(postings) + 0.5) / (len(postings) + 0.5) + 1)
+                for id_, tf, length in postings:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / average_length)
+                    scores[id_] = scores.get(id_, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return [id_ for id_, _ in heapq.nlargest(k, scores.items(), key=lambda item: item[1])]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _existing(self, ids):
+        found = set()
+        ids = list(ids)
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            rows = self._connection.execute(f"SELECT id FROM documents WHERE id IN ({','.join('?' * len(batch))})", batch)
+            found.update(id_ for id_, in rows)
+        return found
+
+
+def reciprocal_rank_fusion(rankings, key, k=60):
+    """
+    Fuses several ranked lists of items into one: score(item) = sum over the lists of 1 / (k + rank).
+    Items are identified across the lists with `key(item)`; the first occurrence is kept.
+    """
+    scores = {}
+    items = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            item_key = key(item)
+            items.setdefault(item_key, item)
+            scores[item_key] = scores.get(item_key, 0.0) + 1.0 / (k + rank)
+    return [items[item_key] for item_key in sorted(scores, key=scores.get, reverse=True)]
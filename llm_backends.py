@@ -0,0 +1,134 @@
+import json
+import os
+import time
+
+
+class LLMRequestError(Exception):
+    """
+    The backend rejected the request (e.g. the chat history is malformed or too long).
+    """
+
+
+class LLMBackend:
+    """
+    Chat model used to answer the questions. Implementations are selected per model version in config.yml
+    through the `llm` class/params entry.
+    chat_history is a list of {"role": "USER" | "CHATBOT" | "SYSTEM", "text": ...} and documents a list of
+    {"title": ..., "snippet": ...}, as in the Cohere chat API.
+    """
+
+    name = "llm"
+
+    def chat(self, message, chat_history=None, documents=None, temperature=0.4, connectors=None):
+        return "".join(self.chat_stream(message, chat_history, documents, temperature, connectors))
+
+    def chat_stream(self, message, chat_history=None, documents=None, temperature=0.4, connectors=None):
+        """
+        Yields the text of the answer as it is generated.
+        """
+        raise NotImplementedError
+
+
+class CohereBackend(LLMBackend):
+
+    name = "cohere"
+
+    def __init__(self, model="command-r-plus", api_key=None):
+        import cohere
+        from cohere.errors import BadRequestError
+        self.model = model
+        self.co = cohere.Client(api_key or os.getenv("COHERE_API_KEY"))
+        self._bad_request = BadRequestError
+
+    def chat(self, message, chat_history=None, documents=None, temperature=0.4, connectors=None):
+        try:
+            return self.co.chat(message=message, model=self.model, chat_history=chat_history or [],
+                                documents=documents or [], temperature=temperature, connectors=connectors or []).text
+        except self._bad_request as e:
+            raise LLMRequestError(str(e)) from e
+
+    def chat_stream(self, message, chat_history=None, documents=None, temperature=0.4, connectors=None):
+        try:
+            for event in self.co.chat_stream(message=message, model=self.model, chat_history=chat_history or [],
+                                             documents=documents or [], temperature=temperature, connectors=connectors or []):
+                if event.event_type == "text-generation":
+                    yield event.text
+                elif event.event_type == "stream-end":
+                    return
+        except self._bad_request as e:
+            raise LLMRequestError(str(e)) from e
+
+
+class OllamaBackend(LLMBackend):
+    """
+    Local model served by Ollama (https://ollama.com), streamed from its /api/chat endpoint.
+    The retrieved documents are passed in a system message since the API has no documents field,
+    and connectors (web search) are not supported.
+    """
+
+    name = "ollama"
+    ROLES = {"USER": "user", "CHATBOT": "assistant", "SYSTEM": "system"}
+
+    def __init__(self, model="mistral", base_url="http://localhost:11434", keep_alive="30m", timeout=120, options=None):
+        import requests
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.options = options or {}
+        # keeps the connection to the server open between two answers
+        self.http = requests.Session()
+
+    def messages(self, message, chat_history=None, documents=None):
+        messages = []
+        if documents:
+            context = "\n\n".join(f"[{i}] {doc.get('title') or ''}\n{doc['snippet']}" for i, doc in enumerate(documents, start=1))
+            messages.append({"role": "system", "content": f"Answer using the following documents when they are relevant.\n\n{context}"})
+        for entry in chat_history or []:
+            messages.append({"role": self.ROLES.get(entry["role"], "user"), "content": entry["text"]})
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    def chat_stream(self, message, chat_history=None, documents=None, temperature=0.4, connectors=None):
+        if connectors:
+            print(f"Connectors are not supported by {self.name}, answering without them")
+        payload = {"model": self.model, "messages": self.messages(message, chat_history, documents), "stream": True,
+                   "keep_alive": self.keep_alive, "options": {"temperature": temperature, **self.options}}
+        with self.http.post(f"{self.base_url}/api/chat", json=payload, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 400:
+                raise LLMRequestError(response.text)
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event.get("error"):
+                    raise LLMRequestError(event["error"])
+                text = event.get("message", {}).get("content")
+                if text:
+                    yield text
+                if event.get("done"):
+                    return
+
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic offline backend: streams `tokens` canned tokens, the first one after `first_token_delay`
+    seconds and then `tokens_per_second` of them. Used to load-test the app and in the benchmark.
+    """
+
+    name = "fake"
+    TEXT = ("This is a canned answer from the offline backend. It does not depend on the question, "
+            "the documents or the chat history, so every run streams exactly the same tokens.").split()
+
+    def __init__(self, tokens=100, tokens_per_second=None, first_token_delay=0.0):
+        self.tokens = tokens
+        self.token_delay = 1.0 / tokens_per_second if tokens_per_second else 0.0
+        self.first_token_delay = first_token_delay
+
+    def chat_stream(self, message, chat_history=None, documents=None, temperature=0.4, connectors=None):
+        time.sleep(self.first_token_delay)
+        for i in range(self.tokens):
+            if i and self.token_delay:
+                time.sleep(self.token_delay)
+            yield self.TEXT[i % len(self.TEXT)] + " "
@@ -0,0 +1,68 @@
+from langchain_core.documents import Document
+
+
+class PDFPageLoader:
+    """
+    Yields the pages of a PDF one at a time with pdfplumber, with the same documents as PDFPlumberLoader.
+    PDFPlumberLoader (langchain-community 0.2.7) extracts every page before yielding the first one; here each page is
+    released once its text is extracted, so a large PDF is never held in memory as a whole.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def load(self):
+        return list(self.lazy_load())
+
+    def lazy_load(self):
+        import pdfplumber
+        with pdfplumber.open(self.file_path) as pdf:
+            metadata = {key: value for key, value in pdf.metadata.items() if isinstance(value, (str, int))}
+            total_pages = len(pdf.pages)
+            for page in pdf.pages:
+                try:
+                    text = page.extract_text()
+                finally:
+                    # drops the parsed objects of the page, kept by pdfplumber until the file is closed
+                    page.close()
+                yield Document(page_content=text,
+                               metadata={"source": self.file_path, "file_path": self.file_path,
+                                         "page": page.page_number - 1, "total_pages": total_pages, **metadata})
+
+
+class ExcelRowLoader:
+    """
+    Yields the rows of an .xlsx workbook, sheet by sheet, as documents of `rows_per_document` rows (tab separated
+    cells). The workbook is opened by openpyxl in read-only mode, which reads the rows from the file as they are
+    iterated instead of loading the whole workbook.
+    """
+
+    def __init__(self, file_path, rows_per_document=50):
+        self.file_path = file_path
+        self.rows_per_document = rows_per_document
+
+    def load(self):
+        return list(self.lazy_load())
+
+    def lazy_load(self):
+        import openpyxl
+        workbook = openpyxl.load_workbook(self.file_path, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                rows, first_row = [], 1
+                for i, row in enumerate(sheet.iter_rows(values_only=True), start=1):
+                    line = "\t".join("" if value is None else str(value) for value in row).strip()
+                    if line:
+                        rows.append(line)
+                    if len(rows) >= self.rows_per_document:
+                        yield self._document(sheet.title, rows, first_row, i)
+                        rows, first_row = [], i + 1
+                if rows:
+                    yield self._document(sheet.title, rows, first_row, i)
+        finally:
+            workbook.close()
+
+    def _document(self, sheet_name, rows, first_row, last_row):
+        return Document(page_content="\n".join(rows),
+                        metadata={"source": self.file_path, "file_path": self.file_path, "page_name": sheet_name,
+                                  "rows": f"{first_row}-{last_row}"})
@@ -0,0 +1,58 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+def file_hash(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class CollectionManifest:
+    """
+    Records, for every source file indexed in a collection, the hash of its content and the ids of its chunks.
+    Used to skip unchanged files and to delete the chunks that a new version of a file no longer has.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, content_hash TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS chunks (source TEXT NOT NULL, chunk_id TEXT NOT NULL, PRIMARY KEY (source, chunk_id));
+        """)
+        self._connection.commit()
+
+    def get(self, source):
+        """
+        Returns (content hash, chunk ids) of a source, or (None, empty set) if it was never indexed.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT content_hash FROM files WHERE source = ?", (source,)).fetchone()
+            ids = {chunk_id for chunk_id, in self._connection.execute("SELECT chunk_id FROM chunks WHERE source = ?", (source,))}
+        return (row[0] if row else None), ids
+
+    def record(self, source, content_hash, chunk_ids):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO files (source, content_hash) VALUES (?, ?)", (source, content_hash))
+            self._connection.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            self._connection.executemany("INSERT OR IGNORE INTO chunks (source, chunk_id) VALUES (?, ?)",
+                                         [(source, chunk_id) for chunk_id in chunk_ids])
+            self._connection.commit()
+
+    def remove(self, source):
+        with self._lock:
+            self._connection.execute("DELETE FROM files WHERE source = ?", (source,))
+            self._connection.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            self._connection.commit()
+
+    def sources(self):
+        with self._lock:
+            return [source for source, in self._connection.execute("SELECT source FROM files ORDER BY source")]
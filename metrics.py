@@ -0,0 +1,221 @@
+import contextvars
+import functools
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from uuid import uuid4
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape_label_value(value):
+    # as required by the Prometheus text format
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels) + "}"
+
+
+class Counter:
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(zip(self.labelnames, key))} {value}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {} # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(values)) for key, values in self._values.items()]
+        for key, values in items:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {values[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {values[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {values[-1]}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics rendered in the Prometheus text format by the /metrics endpoint.
+    Collectors are callables returning (name, type, help, [(labels dict, value)]) tuples; they are only
+    evaluated on scrape, which is how the counters of the caches are exported without touching their hot path.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, type_, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {type_}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+STAGE_SECONDS = registry.register(Histogram("luna_stage_duration_seconds", "Duration of the stages of the RAG pipeline.", ["stage"]))
+ERRORS = registry.register(Counter("luna_errors_total", "Errors raised by the stages of the RAG pipeline.", ["stage"]))
+INGESTED_CHUNKS = registry.register(Counter("luna_ingested_chunks_total", "Chunks added to the collections.", ["topic"]))
+REQUESTS = registry.register(Counter("luna_requests_total", "Chat messages answered.", ["room"]))
+
+
+class Span:
+
+    def __init__(self, name, trace_id, parent_id=None, **attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def to_dict(self):
+        return {"name": self.name, "trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+                "start": self.start, "duration": self.duration, "error": self.error, "attributes": self.attributes}
+
+
+class Tracer:
+    """
+    Minimal in-process tracer. Spans opened while a trace is active (same thread / greenlet) are attached to it,
+    and the last `max_traces` finished traces are kept for the /traces endpoint.
+    """
+
+    def __init__(self, max_traces=200):
+        self.finished = deque(maxlen=max_traces)
+        self._current = contextvars.ContextVar("luna_trace", default=None)
+
+    @contextmanager
+    def trace(self, name, **attributes):
+        trace_id = uuid4().hex
+        root = Span(name, trace_id, **attributes)
+        spans = [root]
+        token = self._current.set((trace_id, root, spans))
+        try:
+            yield root
+        except Exception as e:
+            root.error = repr(e)
+            raise
+        finally:
+            root.duration = time.time() - root.start
+            self._current.reset(token)
+            self.finished.append([span.to_dict() for span in spans])
+
+    def start_span(self, name, **attributes):
+        current = self._current.get()
+        if current is None:
+            return None
+        trace_id, root, spans = current
+        span = Span(name, trace_id, parent_id=root.span_id, **attributes)
+        spans.append(span)
+        return span
+
+    def recent(self, limit=50):
+        return list(self.finished)[-limit:]
+
+
+tracer = Tracer()
+
+
+@contextmanager
+def timed(stage, **attributes):
+    """
+    Records the duration of a stage in the stage histogram and, when a trace is active, as one of its spans.
+    """
+    span = tracer.start_span(stage, **attributes)
+    start = time.perf_counter()
+    try:
+        yield span
+    except Exception as e:
+        ERRORS.inc(stage=stage)
+        if span:
+            span.error = repr(e)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=stage)
+        if span:
+            span.duration = duration
+
+
+def record(stage, duration, **attributes):
+    """
+    Records a duration that was measured by the caller (e.g. the time to the first token of a stream).
+    """
+    STAGE_SECONDS.observe(duration, stage=stage)
+    span = tracer.start_span(stage, **attributes)
+    if span:
+        span.start = time.time() - duration
+        span.duration = duration
+
+
+def timed_function(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
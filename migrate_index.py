@@ -0,0 +1,115 @@
+"""
+Migrates the Chroma collections of a model version to FAISS indexes.
+
+The vectors, texts and metadata are exported from Chroma in batches (nothing is embedded again) and written
+to {vector_db_path}/faiss/{topic}Collection.faiss / .sqlite with the index settings of the `vector_index`
+entry of the model version, or those given on the command line. The Chroma collections are left untouched;
+set `backend: faiss` for the model version (or for some of its topics) to serve them from the new indexes.
+
+Example:
+    python migrate_index.py --version luna-1 --topics python vrp --index-type hnsw --quantization int8
+"""
+import argparse
+import os
+import random
+import time
+
+import chromadb
+
+from faiss_store import FaissVectorStore
+from rag import initialize_component, load_model_from_yaml
+
+
+def collection_names(client):
+    # chromadb < 0.6 returns Collection objects, later versions their names
+    return sorted(getattr(collection, "name", collection) for collection in client.list_collections())
+
+
+def migrate(collection, store, batch_size=5000):
+    count = collection.count()
+    start = time.perf_counter()
+    for offset in range(0, count, batch_size):
+        batch = collection.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+        store.add_embeddings(batch["ids"], batch["documents"], batch["metadatas"], batch["embeddings"])
+        print(f"  {min(offset + batch_size, count)}/{count} chunks")
+    store.save()
+    return count, time.perf_counter() - start
+
+
+def compare(collection, store, k=20, samples=50, seed=0):
+    """
+    Searches both indexes with the vectors of `samples` random chunks and returns the mean search time of
+    each and the overlap of the top `k` (recall of FAISS against Chroma).
+    """
+    count = collection.count()
+    if not count:
+        return {}
+    rng = random.Random(seed)
+    offsets = [rng.randrange(count) for _ in range(min(samples, count))]
+    chroma_ms, faiss_ms, recall = [], [], []
+    for offset in offsets:
+        vector = collection.get(include=["embeddings"], limit=1, offset=offset)["embeddings"][0]
+        t0 = time.perf_counter()
+        expected = collection.query(query_embeddings=[vector], n_results=k, include=["documents"])["documents"][0]
+        t1 = time.perf_counter()
+        found = [doc.page_content for doc in store.similarity_search_by_vector(vector, k=k)]
+        t2 = time.perf_counter()
+        chroma_ms.append((t1 - t0) * 1000)
+        faiss_ms.append((t2 - t1) * 1000)
+        recall.append(len(set(expected) & set(found)) / len(expected) if expected else 1.0)
+    return {"chroma_ms": sum(chroma_ms) / len(chroma_ms), "faiss_ms": sum(faiss_ms) / len(faiss_ms),
+            f"recall@{k}": sum(recall) / len(recall)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the Chroma collections of a model version to FAISS")
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("--family", default="CohereModels")
+    parser.add_argument("--version", default="luna-1")
+    parser.add_argument("--source", default=None, help="Chroma directory, the vector_db_path of the model version by default")
+    parser.add_argument("--topics", nargs="*", default=[], help="topics to migrate, all the collections by default")
+    parser.add_argument("--index-type", choices=["flat", "ivf", "hnsw"], default=None)
+    parser.add_argument("--quantization", choices=["none", "int8", "pq"], default=None)
+    parser.add_argument("--nlist", type=int, default=None, help="number of IVF cells")
+    parser.add_argument("--pq-m", type=int, default=None, help="number of PQ sub-quantizers")
+    parser.add_argument("--hnsw-m", type=int, default=None, help="number of HNSW neighbors")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--compare", type=int, default=50, help="number of sample searches to compare with Chroma (0 to skip)")
+    args = parser.parse_args()
+
+    config = load_model_from_yaml(args.config, args.family, args.version)
+    source = args.source or config['vector_db_path']
+    client = chromadb.PersistentClient(path=source)
+    embedder = initialize_component(config['embedder'])
+    vector_index = config.get('vector_index', {})
+    overrides = {key: value for key, value in {"index_type": args.index_type, "nlist": args.nlist, "pq_m": args.pq_m,
+                                               "hnsw_m": args.hnsw_m}.items() if value is not None}
+    if args.quantization:
+        overrides["quantization"] = None if args.quantization == "none" else args.quantization
+
+    names = [f"{topic}Collection" for topic in args.topics] or collection_names(client)
+    for name in names:
+        topic = name[:-len("Collection")]
+        # same settings as MyRAGModel.vector_index_config, then the command line ones
+        settings = {key: value for key, value in vector_index.items() if key not in ('backend', 'topics')}
+        settings.update({key: value for key, value in vector_index.get('topics', {}).get(topic, {}).items() if key != 'backend'})
+        settings.update(overrides)
+        settings.update(mmap=False, save_interval=float("inf"))
+        collection = client.get_collection(name)
+        first = collection.get(include=["embeddings"], limit=1)["embeddings"]
+        if first is None or not len(first):
+            print(f"{name} is empty, skipped")
+            continue
+        path = os.path.join(source, "faiss", name)
+        store = FaissVectorStore(path, embedder, dimension=len(first[0]), **settings)
+        print(f"Migrating {name} to {path} ({store.factory})...")
+        count, seconds = migrate(collection, store, args.batch_size)
+        size = os.path.getsize(f"{path}.faiss") / 1024 ** 2
+        print(f"{name}: {count} chunks in {seconds:.1f}s ({count / seconds if seconds else 0:.0f} chunks/s), index {size:.1f} MB")
+        if args.compare:
+            print(f"{name}: {compare(collection, store, k=config.get('retrieval_k', 20), samples=args.compare)}")
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,50 @@
 import os
 import yaml
-import cohere
-from cohere.errors import BadRequestError
 import time
-from colorama import Fore, Style
-from langchain_community.document_loaders.pdf import PDFPlumberLoader
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.document_loaders import Docx2txtLoader, UnstructuredExcelLoader, TextLoader, UnstructuredHTMLLoader, UnstructuredPowerPointLoader, PythonLoader
-from langchain_community.vectorstores import FAISS
-import chromadb
-from langchain_chroma import Chroma
-from langchain_text_splitters import CharacterTextSplitter, RecursiveCharacterTextSplitter
-from langchain_cohere import CohereEmbeddings
+import importlib
+from functools import lru_cache
+from langchain_core.embeddings import Embeddings
+from langchain_core.documents import Document
 from dotenv import load_dotenv
-import json
-from copy import copy
+import mimetypes
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from vectorstore_cache import VectorStoreCache
+from embedding_cache import SQLiteEmbeddingCache, content_hash
+from response_cache import SemanticResponseCache, normalize
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from manifest import CollectionManifest, file_hash
+from config_service import ConfigService
+from history_window import ChatHistoryWindow
+from llm_backends import CohereBackend, LLMRequestError
+from rerankers import CohereReranker
+from faiss_store import FaissVectorStore
+from metrics import timed, timed_function, record, ERRORS, INGESTED_CHUNKS
 
 
 load_dotenv()
 
-def timeit(func):
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        print(f"{Fore.GREEN}Function {func.__name__} took {end-start} seconds{Style.RESET_ALL}")
-        return result
-    return wrapper
+class InstrumentedEmbeddings(Embeddings):
+    """
+    Records the time spent embedding documents and queries in the stage metrics.
+    """
+
+    def __init__(self, embedder):
+        self.embedder = embedder
+
+    def __getattr__(self, name):
+        if name == "embedder":
+            raise AttributeError(name)
+        return getattr(self.embedder, name)
+
+    def embed_documents(self, texts):
+        with timed("embed", texts=len(texts)):
+            return self.embedder.embed_documents(texts)
+
+    def embed_query(self, text):
+        with timed("embed_query"):
+            return self.embedder.embed_query(text)
 
 def clean_text(text:str):
     text = text.replace("\n", " ").replace("\r", " ").strip()
@@ -36,186 +53,910 @@ def clean_text(text:str):
 
     return text
 
+def prompt_document(doc):
+    """
+    Document passed to the LLM for a retrieved chunk. Its snippet is cleaned once, when the chunk is added
+    (the `snippet` metadata); chunks added before that are cleaned on the fly.
+    """
+    snippet = doc.metadata.get('snippet')
+    return {"title": doc.metadata.get('source'), "snippet": snippet if snippet is not None else clean_text(doc.page_content)}
 
+def group_sources(docs):
+    """
+    Sources of the retrieved chunks grouped by file, in a single pass: {source: {"pages": [...], "file_path": ...}}
+    """
+    sources = {}
+    for doc in docs:
+        metadata = doc.metadata
+        source = sources.get(metadata.get('source'))
+        if source is None:
+            source = sources[metadata.get('source')] = {"pages": [], "file_path": metadata.get('file_path')}
+        if metadata.get('page') is not None:
+            source["pages"].append(metadata['page'])
+    for source in sources.values():
+        source["pages"].sort()
+    return sources
 
-class MyRAGModel:
 
+# module of every class that can be named in config.yml, imported on first use only: importing all the
+# loaders, chromadb or sentence-transformers up front takes seconds, in the app and in every parsing process
+COMPONENTS = {
+    # embedders
+    "HuggingFaceEmbeddings": "langchain_huggingface",
+    "CohereEmbeddings": "langchain_cohere",
+    # text splitters
+    "CharacterTextSplitter": "langchain_text_splitters",
+    "RecursiveCharacterTextSplitter": "langchain_text_splitters",
+    "SemanticChunker": "langchain_experimental.text_splitter",
+    "CodeSplitter": "splitters",
+    "SemanticSplitter": "splitters",
+    # document loaders
+    "CSVLoader": "langchain_community.document_loaders",
+    "Docx2txtLoader": "langchain_community.document_loaders",
+    "PDFPlumberLoader": "langchain_community.document_loaders.pdf",
+    "PythonLoader": "langchain_community.document_loaders",
+    "TextLoader": "langchain_community.document_loaders",
+    "UnstructuredExcelLoader": "langchain_community.document_loaders",
+    "UnstructuredHTMLLoader": "langchain_community.document_loaders",
+    "UnstructuredMarkdownLoader": "langchain_community.document_loaders",
+    "UnstructuredPowerPointLoader": "langchain_community.document_loaders",
+    "ExcelRowLoader": "loaders",
+    "PDFPageLoader": "loaders",
+    # rerankers
+    "CohereReranker": "rerankers",
+    "CrossEncoderReranker": "rerankers",
+    "NoReranker": "rerankers",
+    # LLM backends
+    "CohereBackend": "llm_backends",
+    "FakeBackend": "llm_backends",
+    "OllamaBackend": "llm_backends",
+}
+
+@lru_cache(maxsize=None)
+def import_component(name):
+    """
+    Returns the class named `name` in COMPONENTS, or given as "package.module.Class".
+    """
+    if name in COMPONENTS:
+        module = COMPONENTS[name]
+    elif "." in name:
+        module, name = name.rsplit(".", 1)
+    else:
+        raise ValueError(f"Unknown component class: {name}")
+    return getattr(importlib.import_module(module), name)
+
+def initialize_component(component_config):
+    component_class = import_component(component_config['class'])
+    return component_class(**component_config['params'])
+
+
+class LazyEmbeddings(Embeddings):
+    """
+    Builds the embedder (e.g. loads the weights of a sentence-transformers model) on first use.
+    Behind the embedding cache, it is not loaded at all as long as every text is already in the cache.
+    Only the attributes of LOADED_ATTRIBUTES load it. Those of its config (e.g. model_name) are read from
+    the config, and any other raises AttributeError, so that a probe like hasattr(embedder, "stats") in the
+    master of gunicorn --preload doesn't load the weights.
+    """
+
+    # attributes that need the model: the client of HuggingFaceEmbeddings (its SentenceTransformer), CohereEmbeddings...
+    # (embed_* and aembed_* are methods of this class)
+    LOADED_ATTRIBUTES = ("client",)
+
+    def __init__(self, component_config):
+        self.component_config = component_config
+        self._embedder = None
+        self._lock = threading.Lock()
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            with self._lock:
+                if self._embedder is None:
+                    with timed("load_embedder"):
+                        self._embedder = initialize_component(self.component_config)
+        return self._embedder
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name == "component_config":
+            raise AttributeError(name)
+        params = self.component_config.get("params") or {}
+        if name in params:
+            return params[name]
+        if name in self.LOADED_ATTRIBUTES:
+            return getattr(self.embedder, name)
+        raise AttributeError(name)
+
+    def embed_documents(self, texts):
+        return self.embedder.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.embedder.embed_query(text)
+
+DEFAULT_LOADERS = {
+    ".doc": {"class": "Docx2txtLoader", "params": {}},
+    ".docx": {"class": "Docx2txtLoader", "params": {}},
+    # `lazy` is the loader of ingest_stream, which yields the file piece by piece instead of loading it whole
+    ".pdf": {"class": "PDFPlumberLoader", "params": {}, "lazy": {"class": "PDFPageLoader", "params": {}}},
+    ".xls": {"class": "UnstructuredExcelLoader", "params": {}},
+    ".xlsx": {"class": "UnstructuredExcelLoader", "params": {}, "lazy": {"class": "ExcelRowLoader", "params": {}}},
+    ".txt": {"class": "TextLoader", "params": {}},
+    ".html": {"class": "UnstructuredHTMLLoader", "params": {}},
+    ".pptx": {"class": "UnstructuredPowerPointLoader", "params": {}},
+    ".py": {"class": "PythonLoader", "params": {}},
+}
+
+
+class LoaderRegistry:
+    """
+    Maps file extensions (".pdf") or MIME types ("application/pdf") to the class/params of the loader that parses them.
+    The `loaders` entry of config.yml extends or overrides DEFAULT_LOADERS.
+    """
+
+    def __init__(self, loaders_config=None):
+        self.loaders = {key.lower(): value for key, value in {**DEFAULT_LOADERS, **(loaders_config or {})}.items()}
+
+    def resolve(self, path):
+        extension = os.path.splitext(path)[1].lower()
+        if extension in self.loaders:
+            return self.loaders[extension]
+        mime_type, _ = mimetypes.guess_type(path)
+        return self.loaders.get(mime_type)
 
-    def __init__(self, topic, config, yaml_file=None, model_family=None):
+    def supports(self, path):
+        return self.resolve(path) is not None
+
+    def get(self, path, lazy=False):
+        loader_config = self.resolve(path)
+        if loader_config is None:
+            raise ValueError(f"Unsupported file type: {path}")
+        if lazy and loader_config.get('lazy'):
+            loader_config = loader_config['lazy']
+        return initialize_component({'class': loader_config['class'], 'params': {**loader_config.get('params', {}), 'file_path': path}})
+
+
+def load_document(path, loaders_config=None):
+    return LoaderRegistry(loaders_config).get(path).load()
+
+def chunk_id(document):
+    """
+    Deterministic id of a chunk, so that adding the same chunk of the same source twice is a no-op.
+    """
+    return content_hash(document.metadata.get('source'), document.metadata.get('page'), document.page_content)
+
+def parse_document(path, text_splitter_config, loaders_config=None):
+    """
+    Loads and splits a single file (only loads it without a text splitter config, e.g. for a splitter that
+    needs the embedder). It only depends on its arguments, so it can run in a worker process.
+    """
+    if text_splitter_config is None:
+        return load_document(path, loaders_config)
+    text_splitter = initialize_component(text_splitter_config)
+    return text_splitter.split_documents(load_document(path, loaders_config))
+
+
+class MyRAGModel:
+    """
+    Holds the heavy resources of a model version (embedder, text splitter, Chroma client, Cohere client).
+    These are built once and shared by every RAGSession opened through `new_session`.
+    """
+
+    def __init__(self, topic, config, yaml_file=None, model_family=None, config_service=None):
         self.yaml_file = yaml_file
         self.model_family = model_family
         self.model_name = config.get('model_name')
-        self.CHANNELS = config.get('channels')
+        # config.yml and prompts.json, cached and reloaded when they change
+        self.config_service = config_service or ConfigService(yaml_file)
+        self._channels = list(config.get('channels') or [])
+        self._prompt = config.get('prompt')
+        # channels shared by the workers of a multi-worker deployment (cluster.RedisChannelStore), if any
+        self.channel_store = None
+        # set in the web workers of a multi-worker deployment, which read the collections written by the ingestion worker
+        self.read_only = False
 
         self.rerank_model = config.get('rerank_model')
         self.chat_model = config['chat_model']
         self.COHERE_API_KEY = config.get('cohere_api_key').format(COHERE_API_KEY=os.getenv("COHERE_API_KEY")) if config.get('cohere_api_key') else None
         
-        self.embedder = self._initialize_component(config['embedder'])
-        self.text_splitter = self._initialize_component(config['text_splitter'])
+        self.embedder_config = config['embedder']
+        self._lazy_embedder = LazyEmbeddings(config['embedder'])
+        self.embedder = self._lazy_embedder
+        if config.get('embedding_cache'):
+            self.embedder = SQLiteEmbeddingCache(self.embedder, path=config['embedding_cache']['path'],
+                                                 namespace=config['embedder']['params'].get('model_name'))
+        self.embedder = InstrumentedEmbeddings(self.embedder)
+        self.text_splitter_config = config['text_splitter']
+        self.text_splitter = self._initialize_component(self.text_splitter_config)
+        # per-channel splitters: `channels` maps a topic to one of the `profiles` (class/params), the others use text_splitter
+        self.splitter_profiles = config.get('splitter_profiles', {})
+        self._text_splitters = {}
+        self.ingestion_config = config.get('ingestion', {})
+        self.loaders_config = config.get('loaders', {})
+        self.loaders = LoaderRegistry(self.loaders_config)
         
         self.vector_db_path = config.get("vector_db_path")
-        self.chroma_persistent_client = chromadb.PersistentClient(path=self.vector_db_path)
+        self.retrieval_k = config.get('retrieval_k', 20)
+        self.hybrid_search = config.get('hybrid_search', {})
+        self._lexical_indexes = {}
+        self._lexical_locks = {} # topic -> lock held while its index is opened (and built)
+        self._manifests = {}
+        # chroma (default) or faiss, per model version and optionally per topic (see vector_index_config)
+        self.vector_index = config.get('vector_index', {})
+        self._faiss_stores = {}
+        self._stores_lock = threading.Lock()
+        self._chroma_client = None
+        # (vector_db_path, collection_name) -> (collection, vectorstore, retriever), shared by all the sessions of the same topic
+        cache_config = config.get('vectorstore_cache', {})
+        self.vectorstores = VectorStoreCache(self._build_vectorstore, max_size=cache_config.get('max_size', 32), 
+                                             idle_ttl=cache_config.get('idle_ttl'))
+        self._lock = threading.Lock()
 
-        self.collection = None
-        self.user = None
         self.topic = topic
-        if not self.topic:
-            pass
-        else:
-            self.collection_name = f"{topic}Collection"
-            self.collection = self.chroma_persistent_client.get_or_create_collection(self.collection_name)
-            self.vectorstore = Chroma(persist_directory=self.vector_db_path, collection_name=self.collection_name, embedding_function=self.embedder)
+        if self.topic:
+            self.get_vectorstore(self.topic)
             print("Vectorstore loaded!")
-            self.retriever = self.vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 20})
 
-        self.co = cohere.Client(self.COHERE_API_KEY)
-        self.prompt = config.get('prompt')
-        self.original_prompt = copy(self.prompt)
-        self.chat_history = []
-        """
-        example: [
-                    {"role": "USER", "text": "Hey, my name is Michael!"},
-                    {"role": "CHATBOT", "text": "Hey Michael! How can I help you today?"},
-                ]
-        """
+        if config.get('llm'):
+            self.llm = self._initialize_component(config['llm'])
+        else:
+            self.llm = CohereBackend(model=self.chat_model, api_key=self.COHERE_API_KEY)
+        # name of the LLM backend, the answers generated at the same time are limited per backend
+        self.chat_backend = self.llm.name
+        self.streaming_config = config.get('streaming', {})
+        if config.get('reranker'):
+            self.reranker = self._initialize_component(config['reranker'])
+        else:
+            self.reranker = CohereReranker(model=self.rerank_model, api_key=self.COHERE_API_KEY)
+        self.response_cache = None
+        response_cache_config = config.get('response_cache', {})
+        if response_cache_config.get('enabled'):
+            self.response_cache = SemanticResponseCache(self.embedder, similarity_threshold=response_cache_config.get('similarity_threshold', 0.95),
+                                                        max_entries=response_cache_config.get('max_entries', 256),
+                                                        ttl=response_cache_config.get('ttl', 3600))
+        self.chat_history_config = config.get('chat_history', {})
+        # the query embedding and vector search of a request run in this pool, while the prompt and the history
+        # window are prepared (or ahead of the request, see RAGSession.prefetch)
+        self.retrieval_pool = ThreadPoolExecutor(max_workers=config.get('retrieval_workers', 8), thread_name_prefix="retrieval")
+        self.prefetch_config = config.get('prefetch', {})
+        # speculative retrievals have their own, smaller pool, so that the messages never wait behind them
+        self.prefetch_pool = ThreadPoolExecutor(max_workers=self.prefetch_config.get('workers', 2), thread_name_prefix="prefetch")
+        # debug dump of the retrieved chunks, written in the background
+        self.retrieved_docs_dump = config.get('retrieved_docs_dump')
+        self._dump_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dump") if self.retrieved_docs_dump else None
     
     def __str__(self):
         return f"Running RAG model: {self.model_name} with vectorstore: {self.vector_db_path}"
     
+    @property
+    def chroma_persistent_client(self):
+        # opened on first use, a model version whose topics all use FAISS never imports chromadb
+        if self._chroma_client is None:
+            with self._stores_lock:
+                if self._chroma_client is None:
+                    import chromadb
+                    self._chroma_client = chromadb.PersistentClient(path=self.vector_db_path)
+        return self._chroma_client
+
+    def warm_up(self):
+        """
+        Loads what is otherwise loaded on first use: the weights of the embedder and the modules of the vector stores
+        and loaders. Run it before forking workers (e.g. gunicorn --preload) so that they share these pages
+        copy-on-write instead of each loading them again. Nothing that can't cross a fork (a SQLite connection,
+        an open collection, a thread) is opened: every worker opens its own on first use.
+        """
+        with timed("warm_up"):
+            # the weights only, without running the model (nor going through the SQLite embedding cache)
+            self._lazy_embedder.embedder
+            default_backend = self.vector_index.get('backend', 'chroma')
+            backends = {default_backend} | {config.get('backend', default_backend) for config in self.vector_index.get('topics', {}).values()}
+            modules = {"chroma": ("chromadb", "langchain_chroma"), "faiss": ("faiss",)}
+            for backend in backends:
+                for module in modules.get(backend, ()):
+                    importlib.import_module(module)
+            for loader_config in self.loaders.loaders.values():
+                import_component(loader_config['class'])
+                if loader_config.get('lazy'):
+                    import_component(loader_config['lazy']['class'])
+        print(f"{self.model_name} warmed up")
+
     def _initialize_component(self, component_config):
-        component_class = globals()[component_config['class']]
-        return component_class(**component_config['params'])
-
-    def _update_yaml(self, channel):
-        # Load the YAML file
-        with open(self.yaml_file, 'r') as file:
-            data = yaml.safe_load(file)
-        # Ensure we are working with the correct dictionary structure
-        model_config = data['models'][self.model_family][self.model_name]        
-        # Update the channels in the YAML file
-        model_config['channels'].append(channel)        
-        # Write the updated YAML file
-        with open(self.yaml_file, 'w') as file:
-            yaml.dump(data, file, default_flow_style=False)
+        return initialize_component(component_config)
 
+    def _persisted(self):
+        # whether the channels and the prompt come from (and go to) config.yml, rather than the config dict only
+        return bool(self.yaml_file and self.model_family and self.model_name)
 
-        
-    def add_channel(self, channel):
-        # Add the channel to the list in the class
-        if channel not in self.CHANNELS:
-            self.CHANNELS.append(channel)
-            self._update_yaml(channel)
-        self.set_topic(channel)
+    @property
+    def CHANNELS(self):
+        if self.channel_store:
+            return self.channel_store.channels()
+        if self._persisted():
+            return self.config_service.channels(self.model_family, self.model_name)
+        return self._channels
 
-    def set_topic(self, topic):
+    @property
+    def original_prompt(self):
+        if self._persisted():
+            return self.config_service.model_config(self.model_family, self.model_name).get('prompt')
+        return self._prompt
+
+    @staticmethod
+    def format_topic(topic):
         # format the topic to be lowercase and without spaces
         topic = str(topic).lower().replace(" ", "_")
         # replace any special characters with an underscore
-        topic = "".join([char if char.isalnum() else "_" for char in topic])
-        self.topic = topic
-        prompt_expertize = json.load(open("prompts.json", "r")).get(topic)
-        if prompt_expertize:
-            self.prompt = self.original_prompt.format(expertise=prompt_expertize, query="{query}")  
+        return "".join([char if char.isalnum() else "_" for char in topic])
+
+    def add_channel(self, channel):
+        # Add the channel to the list in the class
+        if self.channel_store:
+            self.channel_store.add(channel)
+        elif self.read_only:
+            raise RuntimeError("A read-only model adds channels through its channel store only")
+        elif self._persisted():
+            self.config_service.add_channel(self.model_family, self.model_name, channel)
         else:
-            # remove the {expertise} placeholder
-            self.prompt = self.original_prompt.format(expertise="", query="{query}")
-        self.collection_name = f"{topic}Collection"
-        self.collection = self.chroma_persistent_client.get_or_create_collection(self.collection_name)
-        self.vectorstore = Chroma(persist_directory=self.vector_db_path, collection_name=self.collection_name, embedding_function=self.embedder)
-        self.retriever = self.vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 20})
-        
-    def set_user(self, user):
-        self.user = user
+            with self._lock:
+                if channel not in self._channels:
+                    self._channels.append(channel)
+        if not self.read_only:
+            self.get_vectorstore(channel)
+
+    def cache_stats(self):
+        stats = {'vectorstores': self.vectorstores.stats()}
+        if hasattr(self.embedder, 'stats'):
+            stats['embedding_cache'] = self.embedder.stats()
+        if self.response_cache:
+            stats['response_cache'] = self.response_cache.stats()
+        return stats
+
+    def submit_retrieval(self, fn, *args, prefetch=False):
+        # in a copy of the current context, so that the spans of the retrieval belong to the trace of the request
+        pool = self.prefetch_pool if prefetch else self.retrieval_pool
+        return pool.submit(contextvars.copy_context().run, fn, *args)
+
+    def dump_retrieved(self, docs):
+        if self._dump_pool:
+            self._dump_pool.submit(self._write_retrieved, list(docs))
+
+    def _write_retrieved(self, docs):
+        with open(self.retrieved_docs_dump, "w", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(f"{doc.metadata}\n")
+                f.write(f"{doc.page_content}\n")
+                f.write("\n")
+
+    def new_session(self, topic=None, user=None):
+        return RAGSession(self, topic=topic or self.topic, user=user)
+
+    def new_chat_history(self):
+        config = self.chat_history_config
+        return ChatHistoryWindow(summarize=self.summarize_history if config.get('summarize', True) else None,
+                                 max_tokens=config.get('max_tokens', 2000), max_turns=config.get('max_turns', 10))
+
+    SUMMARY_PROMPT = ("Summarize the following conversation between a user and an assistant in at most {max_words} words. "
+                      "Keep the facts, names, numbers and decisions that later questions may refer to.\n\n"
+                      "Summary of the conversation so far: {summary}\n\nNew messages:\n{conversation}")
+
+    def summarize_history(self, summary, messages):
+        """
+        Folds the messages that leave the chat history window into the running summary of the conversation.
+        """
+        conversation = "\n".join(f"{message['role']}: {message['text']}" for message in messages)
+        message = self.SUMMARY_PROMPT.format(max_words=self.chat_history_config.get('summary_max_words', 150),
+                                             summary=summary or "(none)", conversation=conversation)
+        with timed("summarize", messages=len(messages)):
+            return self.llm.chat(message=message, temperature=0.2)
+
+    def get_prompt(self, topic):
+        """
+        Prompt of a topic (PromptTemplate) with its expertise from prompts.json, or none; `render(user=..., query=...)` it.
+        """
+        return self.config_service.prompt(self.original_prompt, topic)
+
+    def get_vectorstore(self, topic):
+        """
+        Returns the warm (collection, vectorstore, retriever) of a topic from the cache, creating them on a miss.
+        """
+        topic = self.format_topic(topic)
+        return self.vectorstores.get(self.vector_db_path, f"{topic}Collection")
+
+    def vector_index_config(self, topic):
+        """
+        Index settings of a topic: the `vector_index` entry of the model version, updated with its `topics` entry.
+        """
+        config = {key: value for key, value in self.vector_index.items() if key != 'topics'}
+        config.update(self.vector_index.get('topics', {}).get(topic, {}))
+        return config
+
+    def _build_vectorstore(self, vector_db_path, collection_name):
+        index_config = self.vector_index_config(collection_name[:-len("Collection")])
+        if index_config.get('backend', 'chroma') == 'faiss':
+            with self._stores_lock:
+                # never evicted: two instances of the same index would overwrite each other's changes
+                store = self._faiss_stores.get((vector_db_path, collection_name))
+                if store is None:
+                    store = self._open_faiss_store(vector_db_path, collection_name, index_config)
+                    if store is None:
+                        return None, None, None
+                    self._faiss_stores[(vector_db_path, collection_name)] = store
+            return store, store, store.as_retriever(search_kwargs={"k": self.retrieval_k})
+        from langchain_chroma import Chroma
+        client = self.chroma_persistent_client
+        if self.read_only:
+            # a read-only model doesn't create collections, the writer does with their first chunks
+            import chromadb.errors
+            try:
+                collection = client.get_collection(collection_name)
+            except (ValueError, getattr(chromadb.errors, "InvalidCollectionException", ValueError)):
+                return None, None, None
+        else:
+            collection = client.get_or_create_collection(collection_name)
+        vectorstore = Chroma(client=client, collection_name=collection_name, embedding_function=self.embedder)
+        retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": self.retrieval_k})
+        return collection, vectorstore, retriever
+
+    def _open_faiss_store(self, vector_db_path, collection_name, index_config):
+        # None for a read-only model, until the writer has created the collection
+        path = os.path.join(vector_db_path, "faiss", collection_name)
+        if self.read_only and not os.path.exists(f"{path}.sqlite"):
+            return None
+        params = {key: value for key, value in index_config.items() if key != 'backend'}
+        return FaissVectorStore(path, self.embedder, read_only=self.read_only, **params)
+
+    def save_topic(self, topic):
+        """
+        Writes what is buffered of the collection of a topic (the FAISS index) so that other processes can read it.
+        """
+        collection_name = f"{self.format_topic(topic)}Collection"
+        with self._stores_lock:
+            store = self._faiss_stores.get((self.vector_db_path, collection_name))
+        if store is not None:
+            store.save()
 
-    @timeit
+    def reload_topic(self, topic):
+        """
+        Reopens the collection of a topic after another process (the writer of a multi-worker deployment)
+        changed it, so that the next requests read the new chunks. Only for a read-only model: the requests
+        running meanwhile finish with the collection they opened, which is never closed nor saved here.
+        """
+        topic = self.format_topic(topic)
+        collection_name = f"{topic}Collection"
+        key = (self.vector_db_path, collection_name)
+        if self.vector_index_config(topic).get('backend', 'chroma') == 'faiss':
+            with self._stores_lock:
+                opened = key in self._faiss_stores
+            if opened:
+                # the old store is closed (its SQLite connection and mapped index) once the last request drops it
+                store = self._open_faiss_store(self.vector_db_path, collection_name, self.vector_index_config(topic))
+                with self._stores_lock:
+                    self._faiss_stores[key] = store
+        elif self._chroma_client is not None:
+            # a Chroma client keeps the HNSW index of the collections it opened in memory, the collection is opened
+            # by a new client. The other topics keep the old one (and their index) until they are reopened too
+            import chromadb
+            with self._stores_lock:
+                # public API of the clients, otherwise PersistentClient returns the one already open for the path
+                self._chroma_client.clear_system_cache()
+                self._chroma_client = chromadb.PersistentClient(path=self.vector_db_path)
+        self.vectorstores.invalidate(*key)
+        with self._lock:
+            self._lexical_indexes.pop(topic, None)
+        if self.response_cache:
+            self.response_cache.invalidate(topic)
+
+    def get_lexical_index(self, topic):
+        """
+        Returns the BM25 index of a topic, stored next to the vector db. It is opened on first use,
+        and built from the documents of the collection if it doesn't exist yet. A read-only model only opens
+        the indexes built by the writer, it returns None for the others.
+        """
+        topic = self.format_topic(topic)
+        index = self._lexical_indexes.get(topic)
+        if index is not None:
+            return index
+        with self._lock:
+            lock = self._lexical_locks.setdefault(topic, threading.Lock())
+        # building the index of a topic can take a while, it only blocks the requests of that topic
+        with lock:
+            if topic in self._lexical_indexes:
+                return self._lexical_indexes[topic]
+            path = os.path.join(self.vector_db_path, "lexical", f"{topic}Collection.sqlite")
+            if self.read_only:
+                if not os.path.exists(path):
+                    return None
+                index = BM25Index(path, read_only=True)
+            else:
+                index = BM25Index(path)
+            if not len(index) and not self.read_only:
+                collection, _, _ = self.get_vectorstore(topic)
+                count = collection.count()
+                for offset in range(0, count, 1000):
+                    batch = collection.get(include=["documents"], limit=1000, offset=offset)
+                    index.add(batch["ids"], batch["documents"])
+            with self._lock:
+                self._lexical_indexes[topic] = index
+            return index
+
+    def get_manifest(self, topic):
+        topic = self.format_topic(topic)
+        with self._lock:
+            if topic not in self._manifests:
+                self._manifests[topic] = CollectionManifest(os.path.join(self.vector_db_path, "manifests", f"{topic}Collection.sqlite"))
+            return self._manifests[topic]
+
+    def file_changed(self, path, topic):
+        """
+        Compares a file with the version indexed in the collection of the topic.
+        Returns (changed, content hash, ids of the chunks indexed for the previous version).
+        """
+        content_hash = file_hash(path)
+        previous_hash, previous_ids = self.get_manifest(topic).get(os.path.normpath(path))
+        return content_hash != previous_hash, content_hash, previous_ids
+
+    def commit_file(self, path, topic, content_hash, previous_ids, chunk_ids):
+        """
+        Deletes the chunks of the previous version of a file that the new one doesn't have and records the new version.
+        Must be called once the chunks of the new version are in the collection.
+        """
+        chunk_ids = set(chunk_ids)
+        self.delete_chunks(previous_ids - chunk_ids, topic)
+        self.get_manifest(topic).record(os.path.normpath(path), content_hash, chunk_ids)
+
+    def delete_chunks(self, ids, topic):
+        if not ids:
+            return
+        topic = self.format_topic(topic)
+        collection, _, _ = self.get_vectorstore(topic)
+        collection.delete(ids=list(ids))
+        if self.hybrid_search.get('enabled'):
+            self.get_lexical_index(topic).delete(ids)
+        if self.response_cache:
+            self.response_cache.invalidate(topic)
+        print(f"Deleted {len(ids)} outdated chunks from collection for topic {topic}")
+
+    def index_file(self, path, topic=None):
+        """
+        Loads, splits and adds a file, re-indexing only what changed since the last time it was indexed.
+        Returns the number of chunks of the file, or None if it is unchanged.
+        """
+        topic = self.format_topic(topic or self.topic)
+        changed, content_hash, previous_ids = self.file_changed(path, topic)
+        if not changed:
+            return None
+        splitted_document, embeddings = self.split_and_embed(self.load_document(path), topic=topic)
+        self.add_document_to_vectorstore(splitted_document, topic=topic, embeddings=embeddings)
+        self.commit_file(path, topic, content_hash, previous_ids, [chunk_id(doc) for doc in splitted_document])
+        return len(splitted_document)
+
+    @timed_function("load")
     def load_document(self, path):
-        if path.endswith(".docx") or path.endswith(".doc"):
-            loader = Docx2txtLoader(file_path=path)
-        elif path.endswith(".pdf"):
-            loader = PDFPlumberLoader(file_path=path, )
-        elif path.endswith(".xlsx") or path.endswith(".xls"):
-            loader = UnstructuredExcelLoader(file_path=path)
-        elif path.endswith(".txt"):
-            loader = TextLoader(file_path=path)
-        elif path.endswith(".html"):
-            loader = UnstructuredHTMLLoader(file_path=path)
-        elif path.endswith(".pptx"):
-            loader = UnstructuredPowerPointLoader(file_path=path)
-        elif path.endswith(".py"):
-            loader = PythonLoader(file_path=path)
-        return loader.load()
+        return self.loaders.get(path).load()
     
-    @timeit
-    def split_text(self, document):
-        splitted_document = self.text_splitter.split_documents(document)
+    def text_splitter_config_for(self, topic=None):
+        profile = self.splitter_profiles.get('channels', {}).get(self.format_topic(topic)) if topic else None
+        return self.splitter_profiles['profiles'][profile] if profile else self.text_splitter_config
+
+    def get_text_splitter(self, topic=None):
+        profile = self.splitter_profiles.get('channels', {}).get(self.format_topic(topic)) if topic else None
+        if profile is None:
+            return self.text_splitter
+        with self._lock:
+            if profile not in self._text_splitters:
+                text_splitter = self._initialize_component(self.splitter_profiles['profiles'][profile])
+                if hasattr(text_splitter, 'split_documents_with_embeddings') and text_splitter.embedder is None:
+                    text_splitter.embedder = self.embedder
+                self._text_splitters[profile] = text_splitter
+            return self._text_splitters[profile]
+
+    def embeds_when_splitting(self, topic=None):
+        """
+        Whether the splitter of a topic embeds the text (SemanticSplitter): it then runs next to the embedder,
+        not in the parsing processes, and its vectors are reused for the chunks.
+        """
+        return hasattr(import_component(self.text_splitter_config_for(topic)['class']), 'split_documents_with_embeddings')
+
+    @timed_function("split")
+    def split_text(self, document, topic=None):
+        splitted_document = self.get_text_splitter(topic).split_documents(document)
         return splitted_document
+
+    @timed_function("split")
+    def split_and_embed(self, documents, topic=None):
+        """
+        Splits documents with the splitter of the topic. Returns (chunks, {chunk id: vector}) when the splitter
+        already embedded the chunks, (chunks, None) otherwise.
+        """
+        text_splitter = self.get_text_splitter(topic)
+        if not hasattr(text_splitter, 'split_documents_with_embeddings'):
+            return text_splitter.split_documents(documents), None
+        chunks, vectors = text_splitter.split_documents_with_embeddings(documents)
+        if vectors is None:
+            return chunks, None
+        return chunks, {chunk_id(chunk): vector for chunk, vector in zip(chunks, vectors)}
     
-    @timeit
-    def add_document_to_vectorstore(self, splitted_document):
-        if not self.collection:
-            print(f"Creating collection for topic {self.topic}...")
-            self.collection_name = f"{self.topic}Collection"
-            self.collection = self.chroma_persistent_client.get_or_create_collection(self.collection_name)
-            self.vectorstore = Chroma.from_documents(documents=splitted_document, embedding=self.embedder, persist_directory=self.vector_db_path, collection_name=f"{self.topic}Collection")
-            self.retriever = self.vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 20})
+    def ingest_stream(self, path, topic=None, batch_size=64, on_progress=None):
+        """
+        Loads, splits and adds a document page by page, writing the chunks in micro-batches of `batch_size`,
+        so that a large PDF or workbook is never held in memory as a whole (with the `lazy` loader of its type,
+        see DEFAULT_LOADERS; the other types are loaded whole and then split page by page).
+        `on_progress(pages, chunks, chunks_written)` is called after every page.
+        An unchanged file is skipped and returns (0, 0).
+        """
+        topic = self.format_topic(topic or self.topic)
+        changed, content_hash, previous_ids = self.file_changed(path, topic)
+        if not changed:
+            return 0, 0
+        batch = []
+        embeddings = {}
+        ids = set()
+        pages = chunks = chunks_written = 0
+        for page in self.loaders.get(path, lazy=True).lazy_load():
+            page_chunks, page_embeddings = self.split_and_embed([page], topic=topic)
+            embeddings.update(page_embeddings or {})
+            ids.update(chunk_id(chunk) for chunk in page_chunks)
+            batch.extend(page_chunks)
+            pages += 1
+            chunks += len(page_chunks)
+            while len(batch) >= batch_size:
+                self.add_document_to_vectorstore(batch[:batch_size], topic=topic, embeddings=embeddings or None)
+                for chunk in batch[:batch_size]:
+                    embeddings.pop(chunk_id(chunk), None)
+                chunks_written += len(batch[:batch_size])
+                batch = batch[batch_size:]
+            if on_progress:
+                on_progress(pages, chunks, chunks_written)
+        if batch:
+            self.add_document_to_vectorstore(batch, topic=topic, embeddings=embeddings or None)
+            chunks_written += len(batch)
+            if on_progress:
+                on_progress(pages, chunks, chunks_written)
+        self.commit_file(path, topic, content_hash, previous_ids, ids)
+        return pages, chunks
+
+    @timed_function("add_documents")
+    def add_document_to_vectorstore(self, splitted_document, topic=None, embeddings=None):
+        """
+        `embeddings` maps chunk ids to the vectors already computed by the splitter (see split_and_embed),
+        the chunks are then written with them instead of being embedded again.
+        """
+        topic = self.format_topic(topic or self.topic)
+        collection, vectorstore, _ = self.get_vectorstore(topic)
+        # skip the chunks that are already in the collection (or twice in this batch)
+        documents = {chunk_id(doc): doc for doc in splitted_document}
+        if embeddings is not None and all(id_ in embeddings for id_ in documents):
+            for doc in documents.values():
+                doc.metadata.setdefault('snippet', clean_text(doc.page_content))
+            ids = list(documents)
+            written = self.add_embeddings_to_vectorstore(ids, [documents[id_].page_content for id_ in ids], [documents[id_].metadata for id_ in ids],
+                                                         [embeddings[id_] for id_ in ids], topic=topic)
+            print(f"Added {written} new chunks ({len(splitted_document) - written} duplicates skipped) to collection for topic {topic}")
+            return
+        existing = set(collection.get(ids=list(documents), include=[])['ids']) if documents else set()
+        new_documents = {id_: doc for id_, doc in documents.items() if id_ not in existing}
+        for doc in new_documents.values():
+            # ready-to-prompt text of the chunk, so that it isn't cleaned again on every query
+            doc.metadata.setdefault('snippet', clean_text(doc.page_content))
+        print(f"Adding {len(new_documents)} new chunks ({len(splitted_document) - len(new_documents)} duplicates skipped) to collection for topic {topic}...")
+        if new_documents:
+            vectorstore.add_documents(list(new_documents.values()), ids=list(new_documents))
+            if self.hybrid_search.get('enabled'):
+                self.get_lexical_index(topic).add(list(new_documents), [doc.page_content for doc in new_documents.values()])
+            INGESTED_CHUNKS.inc(len(new_documents), topic=topic)
+            if self.response_cache:
+                # cached answers may be outdated by the new documents
+                self.response_cache.invalidate(topic)
+
+
+    @timed_function("add_embeddings")
+    def add_embeddings_to_vectorstore(self, ids, texts, metadatas, vectors, topic=None):
+        """
+        Writes chunks that are already embedded (e.g. by the processes of bulk_index.py) in one bulk write.
+        Like add_document_to_vectorstore, the chunks that are already in the collection are skipped.
+        """
+        topic = self.format_topic(topic or self.topic)
+        collection, _, _ = self.get_vectorstore(topic)
+        existing = set(collection.get(ids=list(ids), include=[])['ids']) if ids else set()
+        new = []
+        for i, id_ in enumerate(ids):
+            if id_ not in existing:
+                existing.add(id_) # or twice in this batch
+                new.append(i)
+        if not new:
+            return 0
+        ids, texts, vectors = [ids[i] for i in new], [texts[i] for i in new], [vectors[i] for i in new]
+        # Chroma doesn't accept None metadata values
+        metadatas = [{key: value for key, value in metadatas[i].items() if value is not None} for i in new]
+        if isinstance(collection, FaissVectorStore):
+            collection.add_embeddings(ids, texts, metadatas, vectors)
         else:
-            self.vectorstore.add_documents(splitted_document)
+            for start in range(0, len(ids), self.chroma_persistent_client.get_max_batch_size()):
+                end = start + self.chroma_persistent_client.get_max_batch_size()
+                collection.upsert(ids=ids[start:end], documents=texts[start:end], metadatas=metadatas[start:end],
+                                  embeddings=vectors[start:end])
+        if self.hybrid_search.get('enabled'):
+            self.get_lexical_index(topic).add(ids, texts)
+        INGESTED_CHUNKS.inc(len(ids), topic=topic)
+        if self.response_cache:
+            self.response_cache.invalidate(topic)
+        return len(ids)
+
+
+class RAGSession:
+    """
+    Per-socket state of a conversation (topic, user, prompt and chat history).
+    It only keeps references to the shared resources of its MyRAGModel, so opening one is cheap.
+    """
+
+    def __init__(self, model, topic=None, user=None):
+        self.model = model
+        self.user = user
+        self.topic = None
+        self.chat_history = model.new_chat_history()
+        self._prefetched = None # (query, embedding future, retrieval future, time)
+        self._prefetch_lock = threading.Lock()
+        """
+        example: [
+                    {"role": "USER", "text": "Hey, my name is Michael!"},
+                    {"role": "CHATBOT", "text": "Hey Michael! How can I help you today?"},
+                ]
+        only the last turns are sent to the LLM, the older ones as a summary (see ChatHistoryWindow)
+        """
+        if topic:
+            self.set_topic(topic)
+
+    @property
+    def prompt(self):
+        # looked up on every use, so that a change of config.yml or prompts.json applies to the open sessions too
+        return self.model.get_prompt(self.topic)
+
+    def stores(self):
+        """
+        (collection, vectorstore, retriever) of the topic, or (None, None, None) without a topic. They are looked up
+        in the cache of the model on every request, since they are reopened when another process changes them
+        (see MyRAGModel.reload_topic), but only once per request: pass them on rather than looking them up again.
+        """
+        return self.model.get_vectorstore(self.topic) if self.topic else (None, None, None)
+
+    @property
+    def collection(self):
+        return self.stores()[0]
+
+    @property
+    def vectorstore(self):
+        return self.stores()[1]
+
+    @property
+    def retriever(self):
+        return self.stores()[2]
+
+    def __str__(self):
+        return f"RAGSession(user={self.user}, topic={self.topic}, model={self.model.model_name})"
+
+    def set_topic(self, topic):
+        self.topic = self.model.format_topic(topic)
+        self.model.get_vectorstore(self.topic)
         
+    def set_user(self, user):
+        self.user = user
 
-    @timeit
-    def retrieve_documents(self, query):
-        if self.vectorstore:
-            docs = self.retriever.invoke(query)
-            with open("retrieved_docs.txt", "w", encoding="utf-8") as f:
-                for doc in docs:
-                    f.write(f"{doc.metadata}\n")
-                    f.write(f"{doc.page_content}\n")
-                    f.write("\n")
-            prompt_docs = [{"title": doc.metadata.get('source'), "snippet":clean_text(doc.page_content)} for doc in docs]
-            sources = [{"source": doc.metadata.get('source'), "page": doc.metadata.get('page'), "file_path": doc.metadata.get('file_path')} for doc in docs]
-            # format sources - sources with same "source", should be grouped together
-            updated_sources = {}
-            for source in sources:
-                source_name = source["source"]
-                if source_name not in updated_sources:
-                    updated_sources[source_name] = dict()
-                    # find all pages with the same source
-                    pages = []
-                    for s in sources:
-                        if s["source"] == source_name:
-                            if s['page'] == None:
-                                continue    
-                            pages.append(s["page"])
-                    updated_sources[source_name]["pages"] = sorted(pages)
-                    updated_sources[source_name]["file_path"] = s["file_path"]
-            sources = updated_sources
+    def add_document_to_vectorstore(self, splitted_document):
+        self.model.add_document_to_vectorstore(splitted_document, topic=self.topic)
+
+    def retrieve_documents(self, query, query_vector=None, stores=None):
+        collection, vectorstore, retriever = stores or self.stores()
+        if vectorstore:
+            with timed("vector_search", topic=self.topic):
+                if query_vector is not None:
+                    # the query has already been embedded, don't embed it again
+                    docs = vectorstore.similarity_search_by_vector(query_vector, k=self.model.retrieval_k)
+                else:
+                    docs = retriever.invoke(query)
+            if self.model.hybrid_search.get('enabled'):
+                docs = self.hybrid_search(query, docs, collection=collection)
+            self.model.dump_retrieved(docs)
+            prompt_docs = [prompt_document(doc) for doc in docs]
+            # sources with the same "source" are grouped together
+            sources = group_sources(docs)
         else:
             prompt_docs = []
             sources = []
         return prompt_docs, sources
     
+    def prefetch(self, query):
+        """
+        Starts the retrieval of `query` in the background, e.g. while the user is still typing it.
+        If the message that follows has the same text, it uses this result instead of retrieving again.
+        A session has at most one prefetch running: the one it replaces is cancelled if it hasn't started yet,
+        and while it runs no other is started (the message retrieves on its own if its text differs).
+        """
+        query = query.strip()
+        if not query or not self.model.prefetch_config.get('enabled', True):
+            return None
+        stores = self.stores()
+        if not stores[1]:
+            return None
+        with self._prefetch_lock:
+            if self._prefetched:
+                if self._prefetched[0] == query:
+                    return self._prefetched[2]
+                previous = self._prefetched[2]
+                if not previous.cancel() and not previous.done():
+                    return None
+            embedding = Future()
+            future = self.model.submit_retrieval(self._retrieve, query, embedding, True, stores, prefetch=True)
+            self._prefetched = (query, embedding, future, time.monotonic())
+        return future
+
+    def _take_prefetched(self, query):
+        # (embedding future, retrieval future) of the prefetched query, or None
+        with self._prefetch_lock:
+            prefetched, self._prefetched = self._prefetched, None
+        if not prefetched:
+            return None
+        # a prefetch still waiting for a worker of the prefetch pool is cancelled: the message doesn't wait behind
+        # the prefetches of other sessions, it retrieves in the retrieval pool instead
+        if prefetched[2].cancel():
+            return None
+        if prefetched[0] == query.strip() and time.monotonic() - prefetched[3] < self.model.prefetch_config.get('max_age', 30):
+            return prefetched[1:3]
+        return None
+
+    def _retrieve(self, query, embedding, search=True, stores=None):
+        """
+        Embeds the query, sets it as the result of the `embedding` future as soon as it is available
+        (e.g. for the response cache to be looked up meanwhile), then searches it unless `search` is false.
+        Returns (docs, sources), or None without `search`.
+        """
+        stores = stores or self.stores()
+        with timed("retrieval", topic=self.topic):
+            try:
+                query_vector = self.model.embedder.embed_query(query) if stores[1] or self.model.response_cache else None
+            except Exception as e:
+                embedding.set_exception(e)
+                raise
+            embedding.set_result(query_vector)
+            if not search:
+                return None
+            return self.retrieve_documents(query, query_vector=query_vector, stores=stores)
+
+    def hybrid_search(self, query, vector_docs, collection=None):
+        """
+        Fuses the results of the vector search with the BM25 results (reciprocal rank fusion),
+        so that exact identifiers (function names, algorithm names...) are not missed.
+        """
+        k = self.model.retrieval_k
+        lexical_index = self.model.get_lexical_index(self.topic)
+        if lexical_index is None:
+            # not built yet by the writer
+            return vector_docs
+        with timed("lexical_search", topic=self.topic):
+            ids = lexical_index.search(query, k=self.model.hybrid_search.get('lexical_k', k))
+            lexical_docs = []
+            if ids:
+                if collection is None:
+                    collection = self.collection
+                found = collection.get(ids=ids, include=["documents", "metadatas"])
+                by_id = {id_: Document(page_content=text, metadata=metadata or {}) 
+                         for id_, text, metadata in zip(found["ids"], found["documents"], found["metadatas"])}
+                lexical_docs = [by_id[id_] for id_ in ids if id_ in by_id]
+        fused = reciprocal_rank_fusion([vector_docs, lexical_docs], key=chunk_id, k=self.model.hybrid_search.get('rrf_k', 60))
+        return fused[:k]
+
     def update_chat_history(self, role, text):
-        self.chat_history.append({"role": role, "text": text})
+        self.chat_history.append(role, text)
     
-    @timeit
     def generate_response(self, query, include_citations=False):
         self.update_chat_history("USER", query)
         docs, sources = self.retrieve_documents(query)
-        query = self.prompt.format(user=self.user, query=query)
-
-        # rearank the documents based on the query
-        if docs:
-            results = self.co.rerank(query=query, documents=docs, model=self.rerank_model, 
-                                    rank_fields=["title", "snippet"],
-                                    return_documents=True) # this returns a sorted list of documents based on the relevance to the query
+        # rearank the documents based on the question of the user (not the whole prompt)
+        with timed("rerank", documents=len(docs)):
+            docs = self.model.reranker.rerank(query, docs)
+        query = self.prompt.render(user=self.user, query=query)
 
-            docs = []
-            for res in results.dict()['results']:
-                docs.append(res['document'])
-
-        response = self.co.chat(message=query, model=self.chat_model, documents=docs, chat_history=self.chat_history[:-1])
-        self.update_chat_history("CHATBOT", response.text)
+        with timed("llm_total"):
+            response = self.model.llm.chat(message=query, documents=docs, chat_history=self.chat_history.window())
+        self.update_chat_history("CHATBOT", response)
         if include_citations:
             updated_sources = {}
             for source in sources:
@@ -227,52 +968,92 @@ class MyRAGModel:
             response = {"response": response, "sources": updated_sources}
         return response
     
-    @timeit
     def generate_stream_response(self, query, include_citations=False, search_web=False):
         self.update_chat_history("USER", query)
+        cache = self.model.response_cache
+        cache_vector = None
 
         if search_web:
             connectors =[{"id":"web-search","options":{"site":"arxiv.org"}}]
-            query = self.prompt.format(user=self.user, query=query)
+            query = self.prompt.render(user=self.user, query=query)
+            chat_history = self.chat_history.window()
             whole_answer = ""
             docs = []
             sources = {}
         else:
-            docs, sources = self.retrieve_documents(query)
-            query = self.prompt.format(user=self.user, query=query)
-             # rearank the documents based on the query
-            if docs:
-                results = self.co.rerank(query=query, documents=docs, model=self.rerank_model, 
-                                        rank_fields=["title", "snippet"],
-                                        return_documents=True, 
-                                        top_n=5) # this returns a sorted list of documents based on the relevance to the query
-
-                docs = []
-                for res in results.dict()['results']:
-                    docs.append(res['document'])
+            # only standalone questions go through the cache, follow-ups depend on the rest of the conversation
+            use_cache = cache is not None and len(self.chat_history) == 1
+            # the query is embedded in the background (or already was, if it was prefetched) while the prompt and
+            # the history window, which may have to summarize older turns, are prepared. It is searched there too,
+            # unless the cache may answer it: then it is only searched on a miss
+            prefetched = self._take_prefetched(query)
+            if prefetched:
+                # searched with the stores of the prefetch
+                embedding, retrieval = prefetched
+                stores = None
+            else:
+                stores = self.stores()
+                embedding = Future()
+                retrieval = self.model.submit_retrieval(self._retrieve, query, embedding, not use_cache, stores)
+            user_query = query
+            with timed("prepare"):
+                query = self.prompt.render(user=self.user, query=query)
+                chat_history = self.chat_history.window()
+            with timed("embed_wait", prefetched=prefetched is not None):
+                query_vector = embedding.result()
+            if use_cache and query_vector is not None:
+                cache_vector = normalize(query_vector)
+                cached = cache.lookup(self.topic, cache_vector)
+                if cached:
+                    yield cached.answer
+                    yield "response_end"
+                    if cached.sources:
+                        yield cached.sources
+                    self.update_chat_history("CHATBOT", cached.answer)
+                    return
+            with timed("retrieval_wait", prefetched=prefetched is not None):
+                retrieved = retrieval.result()
+            if retrieved is None:
+                # the cache missed, the query is searched now
+                retrieved = self.retrieve_documents(user_query, query_vector=query_vector, stores=stores)
+            docs, sources = retrieved
+            # rearank the documents based on the question of the user (not the whole prompt)
+            with timed("rerank", documents=len(docs)):
+                docs = self.model.reranker.rerank(user_query, docs, top_n=5)
             whole_answer = ""
             connectors = []
 
+        start = time.perf_counter()
+        first_token = True
         try:
-            for event in self.co.chat_stream(message=query, model=self.chat_model, chat_history=self.chat_history[:-1], 
-                                            documents=docs, temperature=0.4, connectors=connectors):
-                if event.event_type == "text-generation":
-                    whole_answer += event.text
-                    yield event.text
-                elif event.event_type == "stream-end":
+            for attempt in range(2):
+                # on a rejected request the history is retried once with half of the token budget
+                if attempt:
+                    chat_history = self.chat_history.window(max_tokens=self.chat_history.max_tokens // 2)
+                try:
+                    for text in self.model.llm.chat_stream(message=query, chat_history=chat_history, documents=docs, 
+                                                           temperature=0.4, connectors=connectors):
+                        if first_token:
+                            record("llm_first_token", time.perf_counter() - start)
+                            first_token = False
+                        whole_answer += text
+                        yield text
                     yield "response_end"
                     if sources:
                         yield sources
+                    if cache_vector is not None and whole_answer:
+                        cache.store(self.topic, user_query, cache_vector, whole_answer, sources)
                     break
-        except BadRequestError as e:
-            # this is raised when chat history lacks an answer. So we will delete the last 2 messages (user and chatbot messages) and try again
-            print(f"Error: {e}")
-            # pop the last two messages before the last one
-            self.chat_history = self.chat_history[:-3] + self.chat_history[-1:] # this keeps the first x messages up until the -3 index and the last message
-            self.generate_stream_response(query, include_citations, search_web)
-
+                except LLMRequestError as e:
+                    ERRORS.inc(stage="llm")
+                    print(f"Error: {e}")
+                    if attempt or whole_answer:
+                        break
+        finally:
+            record("llm_total", time.perf_counter() - start)
 
-        self.update_chat_history("CHATBOT", whole_answer)
+        if whole_answer:
+            self.update_chat_history("CHATBOT", whole_answer)
 
 
 def my_rag_model_constructor(loader, node):
@@ -289,5 +1070,7 @@ def load_model_from_yaml(yaml_file, model_family, model_version):
 
 # Functions to import and use in another script
 def get_model_version(yaml_file, model_family, model_version) -> MyRAGModel:
-    config = load_model_from_yaml(yaml_file, model_family, model_version)
-    return MyRAGModel(topic=config.get('topic'), config=config, yaml_file=yaml_file, model_family=model_family)
\ No newline at end of file
+    config_service = ConfigService(yaml_file)
+    config = config_service.model_config(model_family, model_version)
+    return MyRAGModel(topic=config.get('topic'), config=config, yaml_file=yaml_file, model_family=model_family,
+                      config_service=config_service)
\ No newline at end of file
@@ -0,0 +1,81 @@
+class Reranker:
+    """
+    Sorts the retrieved documents ({"title": ..., "snippet": ...}) by relevance to the query.
+    Implementations are selected in config.yml through the `reranker` class/params entry.
+    """
+
+    def rerank(self, query, documents, top_n=None):
+        raise NotImplementedError
+
+
+class NoReranker(Reranker):
+    """
+    Keeps the order of the vector search and only cuts the list to `top_n`.
+    """
+
+    def rerank(self, query, documents, top_n=None):
+        return documents[:top_n] if top_n else documents
+
+
+class CohereReranker(Reranker):
+
+    def __init__(self, model="rerank-multilingual-v3.0", api_key=None):
+        import cohere
+        self.model = model
+        self.co = cohere.Client(api_key)
+
+    def rerank(self, query, documents, top_n=None):
+        if not documents:
+            return documents
+        results = self.co.rerank(query=query, documents=documents, model=self.model,
+                                 rank_fields=["title", "snippet"],
+                                 return_documents=True, top_n=top_n) # this returns a sorted list of documents based on the relevance to the query
+        return [res['document'] for res in results.dict()['results']]
+
+
+class CrossEncoderReranker(Reranker):
+    """
+    Local CPU reranker that scores (query, document) pairs with a sentence-transformers cross-encoder, in batches.
+    backend: "torch" (optionally with dynamic int8 quantization of the linear layers) or "onnx" (requires optimum[onnxruntime]).
+    """
+
+    def __init__(self, model_name="cross-encoder/ms-marco-MiniLM-L-6-v2", batch_size=32, max_length=512,
+                 backend="torch", quantize=False, device="cpu"):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.backend = backend
+        if backend == "onnx":
+            from optimum.onnxruntime import ORTModelForSequenceClassification
+            from transformers import AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            self.model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+        elif backend == "torch":
+            from sentence_transformers import CrossEncoder
+            self.model = CrossEncoder(model_name, max_length=max_length, device=device)
+            if quantize:
+                import torch
+                self.model.model = torch.quantization.quantize_dynamic(self.model.model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            raise ValueError(f"Unknown cross-encoder backend: {backend}")
+
+    def score(self, query, texts):
+        pairs = [(query, text) for text in texts]
+        if self.backend == "torch":
+            return [float(score) for score in self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)]
+        scores = []
+        for i in range(0, len(pairs), self.batch_size):
+            batch = pairs[i:i + self.batch_size]
+            features = self.tokenizer([q for q, _ in batch], [t for _, t in batch], padding=True, truncation=True,
+                                      max_length=self.max_length, return_tensors="np")
+            logits = self.model(**features).logits
+            scores.extend(float(row[0]) if len(row) == 1 else float(row[-1]) for row in logits)
+        return scores
+
+    def rerank(self, query, documents, top_n=None):
+        if not documents:
+            return documents
+        texts = [f"{doc.get('title') or ''}\n{doc['snippet']}" for doc in documents]
+        scores = self.score(query, texts)
+        ranked = [doc for _, doc in sorted(zip(scores, documents), key=lambda pair: pair[0], reverse=True)]
+        return ranked[:top_n] if top_n else ranked
@@ -0,0 +1,118 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+def normalize(vector):
+    import numpy as np
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+class CachedResponse:
+
+    def __init__(self, key, query, vector, answer, sources):
+        self.key = key
+        self.query = query
+        self.vector = vector
+        self.answer = answer
+        self.sources = sources
+        self.created_at = time.monotonic()
+
+
+class SemanticResponseCache:
+    """
+    Per-topic cache of answers keyed by the embedding of the question.
+    A new question reuses the answer of a cached one when their cosine similarity is at least `similarity_threshold`.
+    Each topic keeps at most `max_entries` answers (LRU) for at most `ttl` seconds, and the whole topic is
+    invalidated when new documents are added to its collection.
+    The vectors of a topic are also kept as one matrix, replaced (never modified) when its entries change: a lookup
+    takes the current one and scores it outside the lock, so lookups don't wait for each other.
+    """
+
+    def __init__(self, embedder, similarity_threshold=0.95, max_entries=256, ttl=3600):
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._topics = {} # topic -> OrderedDict of CachedResponse, least recently used first
+        self._snapshots = {} # topic -> (entries, matrix of their vectors, array of their creation times)
+        self._lock = threading.Lock()
+        self._keys = itertools.count()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def embed(self, query):
+        return normalize(self.embedder.embed_query(query))
+
+    def lookup(self, topic, vector):
+        """
+        Returns the best cached response of the topic for the (normalized) query vector, or None.
+        """
+        import numpy as np
+        with self._lock:
+            snapshot = self._snapshots.get(topic)
+        best = None
+        expired = []
+        if snapshot:
+            entries, matrix, created_at = snapshot
+            scores = matrix @ np.asarray(vector, dtype=np.float32)
+            if self.ttl:
+                is_expired = time.monotonic() - created_at > self.ttl
+                expired = [entry for entry, is_old in zip(entries, is_expired) if is_old]
+                scores[is_expired] = -np.inf
+            i = int(np.argmax(scores))
+            if scores[i] >= self.similarity_threshold:
+                best = entries[i]
+        with self._lock:
+            current = self._topics.get(topic)
+            if expired and current:
+                for entry in expired:
+                    if current.get(entry.key) is entry:
+                        del current[entry.key]
+                self._update_snapshot(topic)
+            # unless it was evicted or invalidated in the meantime
+            if best is None or current is None or current.get(best.key) is not best:
+                self.misses += 1
+                return None
+            current.move_to_end(best.key)
+            self.hits += 1
+            return best
+
+    def store(self, topic, query, vector, answer, sources):
+        with self._lock:
+            entry = CachedResponse(next(self._keys), query, vector, answer, sources)
+            entries = self._topics.setdefault(topic, OrderedDict())
+            entries[entry.key] = entry
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._update_snapshot(topic)
+
+    def _update_snapshot(self, topic):
+        # called with the lock held
+        import numpy as np
+        entries = tuple(self._topics.get(topic, {}).values())
+        if entries:
+            self._snapshots[topic] = (entries, np.array([entry.vector for entry in entries], dtype=np.float32),
+                                      np.array([entry.created_at for entry in entries]))
+        else:
+            self._snapshots.pop(topic, None)
+
+    def invalidate(self, topic):
+        with self._lock:
+            self._snapshots.pop(topic, None)
+            if self._topics.pop(topic, None):
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "topics": len(self._topics),
+            "entries": sum(len(entries) for entries in self._topics.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
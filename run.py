@@ -0,0 +1,12 @@
+"""
+Starts the development server:
+    python run.py
+
+The parse workers of the ingestion queue are spawned processes, which import the main module of the server before
+they run anything. The app is imported here only under the __main__ guard, so they don't build a second app, model
+and Socket.IO server each, as they would with app.py as the main module.
+"""
+
+if __name__ == '__main__':
+    from app import app, socketio
+    socketio.run(app, debug=True, port=5050)
@@ -0,0 +1,39 @@
+import threading
+
+
+class SessionRegistry:
+    """
+    Keeps one RAGSession per (socket id, room), so that concurrent users never share topic, prompt or chat history.
+    All the sessions are opened from the same MyRAGModel and reuse its embedder, Chroma client and Cohere client.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def open(self, sid, room, user):
+        # joining a room always starts with a fresh chat history
+        session = self.model.new_session(topic=room, user=user)
+        with self._lock:
+            self._sessions[(sid, room)] = session
+        return session
+
+    def get(self, sid, room, user=None):
+        with self._lock:
+            session = self._sessions.get((sid, room))
+        if session is None:
+            # e.g. the server restarted while the client was still connected
+            session = self.open(sid, room, user)
+        return session
+
+    def close(self, sid, room=None):
+        with self._lock:
+            if room is not None:
+                self._sessions.pop((sid, room), None)
+            else:
+                for key in [key for key in self._sessions if key[0] == sid]:
+                    del self._sessions[key]
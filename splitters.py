@@ -0,0 +1,112 @@
+import re
+
+from langchain_core.documents import Document
+from langchain_text_splitters import Language, RecursiveCharacterTextSplitter
+
+
+class CodeSplitter(RecursiveCharacterTextSplitter):
+    """
+    RecursiveCharacterTextSplitter with the separators of a programming language ("python", "js", ...):
+    chunks of source code, or of code-heavy documents, break between classes and functions first.
+    """
+
+    def __init__(self, language="python", chunk_size=1500, chunk_overlap=100, **kwargs):
+        super().__init__(separators=RecursiveCharacterTextSplitter.get_separators_for_language(Language(language)),
+                         is_separator_regex=True, chunk_size=chunk_size, chunk_overlap=chunk_overlap, **kwargs)
+
+
+class SemanticSplitter:
+    """
+    Splits prose where the topic changes, like langchain_experimental's SemanticChunker: between two sentences whose
+    embeddings (averaged with `buffer_size` neighbors on each side) are further apart than the `breakpoint_percentile`
+    of the distances in the document. Unlike SemanticChunker, the sentences of all the documents are embedded in
+    batches of `batch_size`, each once, and chunks are kept between `min_chunk_size` and `max_chunk_size` characters.
+
+    The vector of a chunk is the normalized mean of the vectors of its sentences. split_documents_with_embeddings
+    returns them with the chunks, so that with `reuse_embeddings` the chunks are not embedded a second time.
+    `embedder` is set by MyRAGModel (its cached embedder) when it is not given.
+    """
+
+    SENTENCE_END = re.compile(r"(?<=[.?!])\s+|\n{2,}")
+
+    def __init__(self, embedder=None, breakpoint_percentile=90, buffer_size=1, min_chunk_size=200, max_chunk_size=2000,
+                 batch_size=256, reuse_embeddings=True):
+        self.embedder = embedder
+        self.breakpoint_percentile = breakpoint_percentile
+        self.buffer_size = buffer_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.batch_size = batch_size
+        self.reuse_embeddings = reuse_embeddings
+
+    def split_documents(self, documents):
+        return self.split_documents_with_embeddings(documents)[0]
+
+    def split_documents_with_embeddings(self, documents):
+        """
+        Returns (chunks, vectors of the chunks), or (chunks, None) without `reuse_embeddings`.
+        """
+        import numpy as np
+        documents = list(documents)
+        sentences = [self.sentences(document.page_content) for document in documents]
+        texts = [sentence for document_sentences in sentences for sentence in document_sentences]
+        if not texts:
+            # e.g. only blank pages
+            return [], ([] if self.reuse_embeddings else None)
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            vectors.extend(self.embedder.embed_documents(texts[i:i + self.batch_size]))
+        vectors = self._normalize(np.asarray(vectors, dtype="float32").reshape(len(texts), -1))
+        chunks, chunk_vectors = [], []
+        start = 0
+        for document, document_sentences in zip(documents, sentences):
+            if not document_sentences:
+                continue
+            document_vectors = vectors[start:start + len(document_sentences)]
+            start += len(document_sentences)
+            for group in self._group(document_sentences, document_vectors):
+                chunks.append(Document(page_content=" ".join(document_sentences[i] for i in group), metadata=dict(document.metadata)))
+                chunk_vectors.append(self._normalize(document_vectors[group].mean(axis=0, keepdims=True))[0].tolist())
+        return chunks, (chunk_vectors if self.reuse_embeddings else None)
+
+    def sentences(self, text):
+        sentences = []
+        for sentence in self.SENTENCE_END.split(text):
+            sentence = " ".join(sentence.split())
+            # a "sentence" longer than a chunk (e.g. a table without punctuation) is cut on spaces
+            while len(sentence) > self.max_chunk_size:
+                cut = sentence.rfind(" ", 0, self.max_chunk_size)
+                cut = cut if cut > 0 else self.max_chunk_size
+                sentences.append(sentence[:cut])
+                sentence = sentence[cut:].strip()
+            if sentence:
+                sentences.append(sentence)
+        return sentences
+
+    def _group(self, sentences, vectors):
+        # indexes of the sentences of every chunk
+        import numpy as np
+        if len(sentences) < 2:
+            return [list(range(len(sentences)))] if sentences else []
+        # each sentence with its neighbors, as the combined sentences of SemanticChunker but without embedding them again
+        window = 2 * self.buffer_size + 1
+        padded = np.pad(vectors, ((self.buffer_size, self.buffer_size), (0, 0)), mode="edge")
+        combined = self._normalize(np.stack([padded[i:i + window].mean(axis=0) for i in range(len(sentences))]))
+        distances = 1 - (combined[:-1] * combined[1:]).sum(axis=1)
+        threshold = np.percentile(distances, self.breakpoint_percentile)
+        groups, group, size = [], [0], len(sentences[0])
+        for i in range(1, len(sentences)):
+            breakpoint = distances[i - 1] > threshold and size >= self.min_chunk_size
+            if breakpoint or size + 1 + len(sentences[i]) > self.max_chunk_size:
+                groups.append(group)
+                group, size = [], -1
+            group.append(i)
+            size += 1 + len(sentences[i])
+        groups.append(group)
+        return groups
+
+    @staticmethod
+    def _normalize(vectors):
+        import numpy as np
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
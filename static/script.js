@@ -26,7 +26,8 @@ function formatMessageContent(content) {
 }
 
 document.addEventListener('DOMContentLoaded', () => {
-    const socket = io();
+    // websockets only: a connection stays on the worker that accepted it, so the app needs no sticky sessions
+    const socket = io({ transports: ["websocket"] });
     
     socket.on('joined_room', (data) => {
         const { username, room } = data;
@@ -137,7 +138,11 @@ document.addEventListener('DOMContentLoaded', () => {
             sendButton.disabled = true;
             chatInput.classList.add("disabled");
 
-            socket.on(`message_chunk_${messageId}`, (data) => {
+            socket.on(`message_chunk_${messageId}`, (data, ack) => {
+                // the server sends the next chunks once these are acknowledged
+                if (ack) {
+                    ack();
+                }
                 if (data.chunk === 'response_start') {
                     const typingAnimation = incomingChatDiv.querySelector(".typing-animation");
                     if (typingAnimation) {
@@ -264,26 +269,39 @@ document.addEventListener('DOMContentLoaded', () => {
             for (const file of fileInput.files) {
                 formData.append('files', file);
             }
+            formData.append('room', room);
+            formData.append('sid', socket.id);
             try {
                 const response = await fetch('/upload', {
                     method: 'POST',
                     body: formData
                 });
                 if (response.ok) {
-                    alert('Files uploaded successfully.');
+                    // the spinner is hidden once the 'ingestion_progress' event reports the end of the job
                     uploadFilesButton.style.display = 'none';
                     fileListDiv.style.display = 'none';
                     fileInput.value = '';
                 } else {
                     alert('Failed to upload files.');
+                    loadingSpinner.style.display = 'none';
                 }
             } catch (error) {
                 console.error('Error uploading files:', error);
-            } finally {
                 loadingSpinner.style.display = 'none';
             }
         };
 
+        socket.on('ingestion_progress', (job) => {
+            if (job.status === 'done') {
+                loadingSpinner.style.display = 'none';
+                const failed = Object.keys(job.errors);
+                alert(failed.length > 0 ? `Files processed. Failed to process: ${failed.join(', ')}` : 'Files uploaded successfully.');
+            } else if (job.status === 'failed') {
+                loadingSpinner.style.display = 'none';
+                alert('Failed to process the uploaded files.');
+            }
+        });
+
         const loadChannels = async () => {
             try {
                 socket.emit('get_channels', { username });
@@ -328,9 +346,20 @@ document.addEventListener('DOMContentLoaded', () => {
 
         const initialInputHeight = chatInput.scrollHeight;
 
+        let prefetchTimer = null;
+
         chatInput.addEventListener("input", () => {
             chatInput.style.height = `${initialInputHeight}px`;
             chatInput.style.height = `${chatInput.scrollHeight}px`;
+
+            // once the user stops typing, the server starts retrieving the documents of the message
+            clearTimeout(prefetchTimer);
+            prefetchTimer = setTimeout(() => {
+                const text = chatInput.value.trim();
+                if (text.length >= 8 && !internetSearchCheckbox.checked) {
+                    socket.emit('prefetch', { msg: text, room: room, sender: username });
+                }
+            }, 400);
         });
 
         chatInput.addEventListener("keydown", (e) => {
@@ -0,0 +1,208 @@
+import contextvars
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import ERRORS
+
+
+_END = object()
+
+
+class StreamCancelled(Exception):
+    pass
+
+
+class AnswerStream:
+    """
+    Bounded buffer between the thread generating an answer and the task emitting it to the client.
+    When the emitting side falls behind, `put` blocks, which in turn stops reading from the LLM stream.
+    """
+
+    def __init__(self, key, backend, queue_size=64, stall_timeout=60):
+        self.key = key
+        self.backend = backend
+        self.stall_timeout = stall_timeout
+        self.cancelled = threading.Event()
+        self.done = threading.Event() # set once the generating thread has stopped
+        self.error = None
+        self._chunks = queue.Queue(maxsize=queue_size)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def put(self, item):
+        deadline = time.monotonic() + self.stall_timeout if self.stall_timeout else None
+        while not self.cancelled.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if deadline and time.monotonic() > deadline:
+                    # nobody is reading anymore
+                    self.cancel()
+        raise StreamCancelled()
+
+    def finish(self):
+        # never blocks, the consumer stops at the first _END it finds
+        self.done.set()
+        while True:
+            try:
+                self._chunks.put_nowait(_END)
+                return
+            except queue.Full:
+                try:
+                    self._chunks.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def __iter__(self):
+        return self.iter()
+
+    def iter(self, timeout=None):
+        """
+        Yields the chunks of the answer; with a `timeout`, also yields None when nothing arrived for `timeout` seconds.
+        """
+        while True:
+            try:
+                item = self._chunks.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if item is _END:
+                return
+            yield item
+
+
+class ChunkBatcher:
+    """
+    Coalesces the tokens of an answer into bigger chunks, so that an answer is sent in a few dozen frames
+    instead of one per token. Pending text is flushed once it reaches `flush_bytes` or is `flush_interval`
+    seconds old. The client concatenates the chunks anyway, so it doesn't see the difference.
+    With `max_unacked`, `emit(text, ack)` is given a callback to call once the client has received the chunk,
+    and no more than `max_unacked` chunks are left unacknowledged: `flush` blocks until the client catches up,
+    and raises StreamCancelled after `ack_timeout` seconds without an acknowledgement.
+    """
+
+    def __init__(self, emit, flush_bytes=256, flush_interval=0.03, max_unacked=None, ack_timeout=60):
+        self.emit = emit
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.ack_timeout = ack_timeout
+        self._unacked = threading.Semaphore(max_unacked) if max_unacked else None
+        self.parts = [] # the whole answer
+        self._pending = 0 # index in parts of the first token not emitted yet
+        self._pending_bytes = 0
+        self._pending_since = None
+
+    def add(self, text):
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        self.parts.append(text)
+        self._pending_bytes += len(text.encode('utf-8'))
+        if self._pending_bytes >= self.flush_bytes:
+            self.flush()
+        else:
+            self.tick()
+
+    def tick(self):
+        # called on every token and when the stream is idle, flushes text older than the interval
+        if self._pending_since is not None and time.monotonic() - self._pending_since >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._pending < len(self.parts):
+            text = "".join(self.parts[self._pending:])
+            if self._unacked:
+                # emit returns as soon as the chunk is queued for the client, whatever the speed of its connection
+                if not self._unacked.acquire(timeout=self.ack_timeout):
+                    raise StreamCancelled()
+                self.emit(text, lambda *args: self._unacked.release())
+            else:
+                self.emit(text)
+            self._pending = len(self.parts)
+        self._pending_bytes = 0
+        self._pending_since = None
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+
+class StreamManager:
+    """
+    Runs the generation of the answers in a pool of worker threads, so that a Socket.IO handler returns
+    as soon as the answer is started and a slow answer doesn't hold anything else up.
+    - at most `backend_limits[backend]` answers are generated at the same time per LLM backend,
+    - every answer is keyed by (socket id, room) and can be cancelled, e.g. when the client leaves or disconnects,
+    - at most one answer per key is generated at a time, since the answers of a key write to the same chat history.
+    """
+
+    def __init__(self, max_workers=32, backend_limits=None, queue_size=64, stall_timeout=60):
+        self.queue_size = queue_size
+        self.stall_timeout = stall_timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="answer")
+        self._semaphores = {backend: threading.BoundedSemaphore(limit) for backend, limit in (backend_limits or {}).items()}
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._active)
+
+    def start(self, key, backend, generate):
+        """
+        Starts `generate()` (a generator of chunks) in the pool and returns the AnswerStream to read them from.
+        A previous answer still running for the same key is cancelled, and this one starts once it has stopped.
+        """
+        stream = AnswerStream(key, backend, queue_size=self.queue_size, stall_timeout=self.stall_timeout)
+        with self._lock:
+            previous = self._active.get(key)
+            self._active[key] = stream
+        if previous:
+            previous.cancel()
+        # the worker runs in a copy of the caller's context, so that its spans are attached to the current trace
+        self._pool.submit(contextvars.copy_context().run, self._produce, stream, generate, previous)
+        return stream
+
+    def cancel(self, sid, room=None):
+        with self._lock:
+            streams = [stream for key, stream in self._active.items() if key[0] == sid and (room is None or key[1] == room)]
+        for stream in streams:
+            stream.cancel()
+
+    def _produce(self, stream, generate, previous=None):
+        semaphore = self._semaphores.get(stream.backend)
+        acquired = False
+        generator = None
+        try:
+            if previous:
+                while not previous.done.wait(timeout=0.1):
+                    if stream.cancelled.is_set():
+                        raise StreamCancelled()
+            if semaphore:
+                while not (acquired := semaphore.acquire(timeout=0.1)):
+                    if stream.cancelled.is_set():
+                        raise StreamCancelled()
+            generator = generate()
+            for chunk in generator:
+                if stream.cancelled.is_set():
+                    raise StreamCancelled()
+                stream.put(chunk)
+        except StreamCancelled:
+            pass
+        except Exception as e:
+            traceback.print_exc()
+            ERRORS.inc(stage="stream")
+            stream.error = e
+        finally:
+            if generator is not None:
+                # closes the underlying HTTP stream of the LLM if the answer was cancelled
+                generator.close()
+            if acquired:
+                semaphore.release()
+            with self._lock:
+                if self._active.get(stream.key) is stream:
+                    del self._active[stream.key]
+            stream.finish()
@@ -0,0 +1,55 @@
+import zlib
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+
+from faiss_store import FaissVectorStore
+
+
+DIMENSION = 16
+
+
+class RandomEmbeddings:
+    """
+    Embeds a text as a random vector seeded by the text, the same every time.
+    """
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return np.random.default_rng(zlib.crc32(text.encode())).standard_normal(DIMENSION).tolist()
+
+
+INDEXES = [
+    {"index_type": "flat"},
+    {"index_type": "hnsw", "hnsw_m": 8},
+    {"index_type": "ivf", "nlist": 4, "nprobe": 4, "train_size": 100},
+    {"index_type": "flat", "quantization": "int8", "train_size": 100},
+    {"index_type": "flat", "quantization": "pq", "pq_m": 2, "train_size": 256},
+]
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+@pytest.mark.parametrize("params", INDEXES, ids=lambda params: "-".join(str(value) for value in params.values()))
+def test_search_after_delete(tmp_path, params, mmap):
+    embedder = RandomEmbeddings()
+    store = FaissVectorStore(str(tmp_path / "collection"), embedder, mmap=mmap, dimension=DIMENSION, **params)
+    ids = [f"chunk-{i}" for i in range(300)]
+    texts = [f"text of chunk {i}" for i in range(300)]
+    store.add_embeddings(ids, texts, [{"i": i} for i in range(300)], embedder.embed_documents(texts))
+    store.save()
+
+    deleted = set(texts[::2])
+    store.delete(ids[::2])
+    store.save()
+
+    assert store.count() == 150
+    for text in texts[1::2]:
+        found = [doc.page_content for doc in store.similarity_search(text, k=5)]
+        assert text in found
+        assert not deleted & set(found)
+    for text in deleted:
+        assert not deleted & {doc.page_content for doc in store.similarity_search(text, k=5)}
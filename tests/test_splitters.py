@@ -0,0 +1,37 @@
+from langchain_core.documents import Document
+
+from splitters import SemanticSplitter
+
+
+class CountingEmbeddings:
+    """
+    Embeds a text as (length, number of words, 1), and counts the texts it embedded.
+    """
+
+    def __init__(self):
+        self.texts = 0
+
+    def embed_documents(self, texts):
+        self.texts += len(texts)
+        return [[float(len(text)), float(len(text.split())), 1.0] for text in texts]
+
+
+def test_semantic_splitter_without_sentences():
+    embedder = CountingEmbeddings()
+    splitter = SemanticSplitter(embedder=embedder)
+
+    assert splitter.split_documents_with_embeddings([]) == ([], [])
+    assert splitter.split_documents_with_embeddings([Document(page_content=" \n\n \t", metadata={"page": 0})]) == ([], [])
+    assert embedder.texts == 0
+
+
+def test_semantic_splitter_skips_blank_pages():
+    splitter = SemanticSplitter(embedder=CountingEmbeddings(), min_chunk_size=10)
+    pages = [Document(page_content="  ", metadata={"page": 0}),
+             Document(page_content="The first sentence. The second one.", metadata={"page": 1}),
+             Document(page_content="\n\n", metadata={"page": 2})]
+
+    chunks, vectors = splitter.split_documents_with_embeddings(pages)
+
+    assert chunks and len(chunks) == len(vectors)
+    assert {chunk.metadata["page"] for chunk in chunks} == {1}
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class VectorStoreCache:
+    """
+    Bounded LRU cache of warm (collection, vectorstore, retriever) tuples keyed by (vector_db_path, collection_name).
+    Entries that have not been used for `idle_ttl` seconds are evicted on the next lookup.
+    A missing entry is built by `factory` outside the lock, once: the concurrent lookups of the same key wait for it,
+    the lookups of the other keys don't.
+    """
+
+    def __init__(self, factory, max_size=32, idle_ttl=None):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict() # key -> (entry, last access)
+        self._building = {} # key -> Future of the entry
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, vector_db_path, collection_name):
+        key = (vector_db_path, collection_name)
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+            if key in self._entries:
+                entry, _ = self._entries.pop(key)
+                self._entries[key] = (entry, now)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            building = self._building.get(key)
+            builder = building is None
+            if builder:
+                building = self._building[key] = Future()
+        if not builder:
+            # being built by another thread
+            return building.result()
+        try:
+            entry = self.factory(vector_db_path, collection_name)
+        except BaseException as e:
+            with self._lock:
+                if self._building.get(key) is building:
+                    del self._building[key]
+            building.set_exception(e)
+            raise
+        with self._lock:
+            # unless it was invalidated meanwhile
+            if self._building.get(key) is building:
+                del self._building[key]
+                self._entries[key] = (entry, time.monotonic())
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        building.set_result(entry)
+        return entry
+
+    def invalidate(self, vector_db_path, collection_name):
+        with self._lock:
+            self._entries.pop((vector_db_path, collection_name), None)
+            self._building.pop((vector_db_path, collection_name), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._building.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _evict_idle(self, now):
+        if not self.idle_ttl:
+            return
+        # entries are kept in access order, so the idle ones are always at the front
+        while self._entries:
+            key, (_, last_access) = next(iter(self._entries.items()))
+            if now - last_access < self.idle_ttl:
+                break
+            del self._entries[key]
+            self.evictions += 1